@@ -13,6 +13,7 @@ from baboon.baboon.notifier import Notifier
 from baboon.baboon.config import check_user, check_server, check_project
 from baboon.baboon.config import check_config, config, dump, SCMS
 from baboon.common.logger import logger
+from baboon.common.stats import StatsReporter
 from baboon.common.utils import exec_cmd
 from baboon.common.errors.baboon_exception import BaboonException
 from baboon.common.errors.baboon_exception import CommandException
@@ -46,6 +47,12 @@ def start():
     except:
         pass
 
+    # If the stats interval is configured, periodically log the transfer
+    # statistics.
+    stats_interval = config['server'].get('stats_interval')
+    if stats_interval:
+        StatsReporter(int(stats_interval)).start()
+
     metadirs = []
     monitor = None
     transport = None
@@ -53,7 +60,7 @@ def start():
     try:
         transport = _start_transport()
         monitor = _start_monitor()
-        metadirs = _start_metadirs(monitor.handler.exclude)
+        metadirs = _start_metadirs(monitor.handlers)
 
         # Wait until the transport is disconnected before exiting Baboon.
         _wait_disconnect(transport)
@@ -306,13 +313,17 @@ def _start_monitor():
     return monitor
 
 
-def _start_metadirs(exclude=None):
-    """ Builds and returns all metadirs. exclude is the exclude_method
-    optionally needed by the MetadirController constructor.
+def _start_metadirs(handlers=None):
+    """ Builds and returns all metadirs. handlers is the dict of the event
+    handlers of the projects. The exclude method of the project handler is
+    given to its MetadirController.
     """
 
     metadirs = []
     for project, project_attrs in config['projects'].iteritems():
+        handler = (handlers or {}).get(project)
+        exclude = handler.exclude if handler else None
+
         # For each project, verify if the .baboon metadir is valid and
         # take some decisions about needed actions on the repository.
         metadir = MetadirController(project, project_attrs['path'], exclude)
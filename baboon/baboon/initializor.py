@@ -1,15 +1,131 @@
 import os
 import shutil
+import subprocess
 import time
 import shelve
 
 from os.path import join, relpath, getmtime, exists
 
+from baboon.baboon import policy
+from baboon.baboon import universe
 from baboon.baboon.config import config
-from baboon.common.file import FileEvent
+from baboon.common.file import FileEvent, is_under
 from baboon.common.eventbus import eventbus
 from baboon.common.logger import logger
-from baboon.common.errors.baboon_exception import BaboonException
+from baboon.common.errors.baboon_exception import BaboonException, \
+    ConfigException
+
+# The ways to detect the changes made while baboon was not running: compare
+# the mtime of each file with the last sync (mtime) or ask git (git).
+MTIME = 'mtime'
+GIT = 'git'
+STARTUP_MODES = (MTIME, GIT)
+
+
+@logger
+class SyncedIndex(object):
+    """ A private git index file in the metadir that describes the files as
+    they were last synced. At startup, git compares it with the working tree
+    using its stat data, without walking the ignored directories.
+    """
+
+    def __init__(self, project_path, metadir_path):
+
+        self.project_path = os.path.expanduser(project_path)
+        self.path = os.path.abspath(os.path.expanduser(join(
+            metadir_path, 'synced-index')))
+
+    def exists(self):
+        """ Returns True if the index is already created.
+        """
+
+        return exists(self.path)
+
+    def seed(self):
+        """ Creates the index from the HEAD commit, i.e. the tree cloned
+        server-side by the git init.
+        """
+
+        self._git(['read-tree', 'HEAD'])
+        self._git(['update-index', '-q', '--refresh'], check=False)
+
+    def get_changes(self):
+        """ Returns the list of (event type, relative path) of the files
+        changed since their last sync.
+        """
+
+        changes = []
+
+        # The modified and deleted files, based on the stat data of the index.
+        output = self._git(['diff-files', '--name-status', '-z'])
+        fields = [x for x in output.split('\0') if x]
+        for status, rel_path in zip(fields[::2], fields[1::2]):
+            if status == 'D':
+                changes.append((FileEvent.DELETE, rel_path))
+            else:
+                changes.append((FileEvent.MODIF, rel_path))
+
+        # The new files, not ignored.
+        output = self._git(['ls-files', '-z', '--others',
+                            '--exclude-standard'])
+        for rel_path in [x for x in output.split('\0') if x]:
+            changes.append((FileEvent.CREATE, rel_path))
+
+        return changes
+
+    def update(self, files):
+        """ Updates the index with the synced files.
+        """
+
+        paths = []
+        for f in files:
+            paths.append(f.src_path)
+            if f.dest_path:
+                paths.append(f.dest_path)
+
+            # The files of a moved directory.
+            if f.event_type == FileEvent.MOVE:
+                paths += self._get_files(f.src_path)
+                paths += self._get_files(f.dest_path)
+
+        # The .git directory and the directories cannot be in an index.
+        paths = [x for x in paths if not is_under(x, '.git') and
+                 not os.path.isdir(join(self.project_path, x))]
+        if paths:
+            self._git(['update-index', '--add', '--remove', '-z', '--stdin'],
+                      '\0'.join(paths) + '\0')
+
+    def _get_files(self, rel_path):
+        """ Returns the paths of the files of the rel_path directory, in the
+        index and in the working tree.
+        """
+
+        output = self._git(['ls-files', '-z', '--', rel_path])
+        files = [x for x in output.split('\0') if x and x != rel_path]
+
+        fullpath = join(self.project_path, rel_path)
+        if os.path.isdir(fullpath):
+            for root, _, names in os.walk(fullpath):
+                for name in names:
+                    files.append(relpath(join(root, name), self.project_path))
+
+        return files
+
+    def _git(self, args, data=None, check=True):
+        """ Runs the git command with the args on the index and returns its
+        output.
+        """
+
+        env = dict(os.environ, GIT_INDEX_FILE=self.path)
+        proc = subprocess.Popen(['git'] + args, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                cwd=self.project_path, env=env)
+        output, errors = proc.communicate(data)
+        if check and proc.returncode:
+            raise BaboonException("Cannot run git %s: %s" % (args[0],
+                                                             errors))
+
+        return output
 
 
 @logger
@@ -27,6 +143,16 @@ class MetadirController(object):
         self.metadir_path = join(self.project_path, MetadirController.METADIR)
         self.exclude_method = exclude_method
 
+        # If the changes are detected by git at startup, the synced index of
+        # the project.
+        startup = config['projects'].get(project, {}).get('startup', MTIME)
+        if startup not in STARTUP_MODES:
+            raise ConfigException("The startup of %s must be one of %s." %
+                                  (project, ', '.join(STARTUP_MODES)))
+        self.synced_index = None
+        if startup == GIT:
+            self.synced_index = SyncedIndex(project_path, self.metadir_path)
+
         eventbus.register('rsync-finished-success', self._on_rsync_finished)
 
     def go(self):
@@ -86,16 +212,30 @@ class MetadirController(object):
         try:
             for f in files:
                 if f.event_type == FileEvent.MOVE:
-                    del self.index[f.src_path]
-                    self.index[f.dest_path] = cur_timestamp
+                    # The src path is maybe a directory.
+                    for path in [x for x in self.index.keys() if
+                                 is_under(x, f.src_path)]:
+                        del self.index[path]
+                        self.index[f.dest_path + path[len(f.src_path):]] = \
+                            cur_timestamp
+
+                    if os.path.isfile(join(self.project_path, f.dest_path)):
+                        self.index[f.dest_path] = cur_timestamp
                 elif f.event_type == FileEvent.DELETE:
-                    del self.index[f.src_path]
+                    for path in [x for x in self.index.keys() if
+                                 is_under(x, f.src_path)]:
+                        del self.index[path]
                 else:
                     self.index[f.src_path] = cur_timestamp
 
             # TODO: Verify if it's not a performance issue (maybe on big
             # project).
             self.index.sync()
+
+            if self.synced_index:
+                self.synced_index.update(files)
+        except BaboonException as err:
+            self.logger.error(err)
         except ValueError:
             # If the index shelve is already closed, a ValueError is raised.
             # In this case, the last rsync will not be persisted on disk. Not
@@ -107,43 +247,96 @@ class MetadirController(object):
         """
 
         cur_files = []
+        large_file_policy = policy.get_policy(self.project)
+
+        # With the git startup detection, only the .git directory is scanned.
+        # The other changes are given by git.
+        rel_paths = None
+        if self.synced_index:
+            if not self.synced_index.exists():
+                self.synced_index.seed()
+            rel_paths = self._walk(join(self.project_path, '.git'))
 
         self.logger.info("[%s] startup initialization..." % self.project)
-        for root, _, files in os.walk(self.project_path):
-            for name in files:
-                fullpath = join(root, name)
-                rel_path = relpath(fullpath, self.project_path)
+        for rel_path in rel_paths if rel_paths is not None else \
+                self._get_files():
+            fullpath = join(self.project_path, rel_path)
 
-                # Add the current file to the cur_files list.
-                cur_files.append(rel_path)
+            # Add the current file to the cur_files list.
+            cur_files.append(rel_path)
 
-                # Get the last modification timestamp of the current file.
+            # Get the last modification timestamp of the current file.
+            try:
                 cur_timestamp = getmtime(fullpath)
-
-                # Get the last rsync timestamp of the current file.
-                register_timestamp = self.index.get(rel_path)
-
-                # If the file is not excluded...
-                if not self.exclude_method or not \
-                        self.exclude_method(rel_path):
-                    # Verify if it's a new file...
-                    if register_timestamp is None:
-                        self.logger.info("Need to create: %s" % rel_path)
-                        FileEvent(self.project, FileEvent.CREATE,
-                                  rel_path).register()
-                    elif (register_timestamp and cur_timestamp >
-                          register_timestamp):
-                        self.logger.info("Need to sync: %s" % rel_path)
-                        FileEvent(self.project, FileEvent.MODIF,
-                                  rel_path).register()
+            except OSError:
+                # A broken symlink.
+                continue
+
+            # Get the last rsync timestamp of the current file.
+            register_timestamp = self.index.get(rel_path)
+
+            # If the file is not excluded nor skipped by the large file
+            # policy...
+            if (not self.exclude_method or not
+                    self.exclude_method(rel_path)) and \
+                    large_file_policy.get_action(rel_path) != policy.SKIP:
+                # Verify if it's a new file...
+                if register_timestamp is None:
+                    self.logger.info("Need to create: %s" % rel_path)
+                    FileEvent(self.project, FileEvent.CREATE,
+                              rel_path).register()
+                elif (register_timestamp and cur_timestamp >
+                      register_timestamp):
+                    self.logger.info("Need to sync: %s" % rel_path)
+                    FileEvent(self.project, FileEvent.MODIF,
+                              rel_path).register()
 
         # Verify if there's no file deleted since the last time.
+        cur_files = set(cur_files)
         for del_file in [x for x in self.index.keys() if x not in cur_files]:
+            if self.synced_index and not del_file.startswith('.git/'):
+                continue
+
             self.logger.info("Need to delete: %s" % del_file)
             FileEvent(self.project, FileEvent.DELETE, del_file).register()
 
+        if self.synced_index:
+            for event_type, rel_path in self.synced_index.get_changes():
+                # If the file is not excluded nor skipped by the large file
+                # policy...
+                if (not self.exclude_method or not
+                        self.exclude_method(rel_path)) and (
+                        event_type == FileEvent.DELETE or
+                        large_file_policy.get_action(rel_path) !=
+                        policy.SKIP):
+                    self.logger.info("Need to sync: %s" % rel_path)
+                    FileEvent(self.project, event_type, rel_path).register()
+
         self.logger.info("[%s] ready !" % self.project)
 
+    def _get_files(self):
+        """ Returns the relative paths of the files of the project. If the
+        universe of the project is given by git, the ignored directories are
+        not walked.
+        """
+
+        git_universe = universe.get_universe(self.project)
+        if git_universe:
+            return git_universe.get_files()
+
+        return self._walk(self.project_path)
+
+    def _walk(self, path):
+        """ Returns the relative paths of the files under the path.
+        """
+
+        files = []
+        for root, _, names in os.walk(path):
+            for name in names:
+                files.append(relpath(join(root, name), self.project_path))
+
+        return files
+
     def delete(self):
         """ Deletes the metadir from the project.
         """
@@ -10,7 +10,9 @@ from abc import ABCMeta, abstractmethod, abstractproperty
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
+from baboon.baboon import policy
 from baboon.baboon.config import config
+from baboon.baboon.normalizer import Normalizer
 from baboon.common.file import FileEvent, pending
 from baboon.common.eventbus import eventbus
 from baboon.common.logger import logger
@@ -19,6 +21,33 @@ from baboon.common.errors.baboon_exception import BaboonException
 lock = Lock()
 
 
+def create_tarball(project_path, rel_paths):
+    """ Returns a temporary file with the gzipped tarball of the rel_paths
+    files of the project_path and the list of the files really added. The
+    missing files are ignored.
+    """
+
+    added = []
+    tmp = tempfile.TemporaryFile()
+    # TarFile is not a context manager in python 2.6.
+    tar = tarfile.open(fileobj=tmp, mode='w:gz')
+    try:
+        for rel_path in rel_paths:
+            try:
+                tar.add(join(project_path, rel_path), arcname=rel_path,
+                        recursive=False)
+                added.append(rel_path)
+            except EnvironmentError:
+                # The file is maybe already deleted. The next event will
+                # fix it.
+                pass
+    finally:
+        tar.close()
+
+    tmp.seek(0)
+    return tmp, added
+
+
 @logger
 class EventHandler(FileSystemEventHandler):
     """ An abstract class that extends watchdog FileSystemEventHandler in
@@ -65,13 +94,30 @@ class EventHandler(FileSystemEventHandler):
 
         with lock:
             project = self._get_project(event.src_path)
+
+            # A directory is moved at once if both paths are synced.
+            # Otherwise, the events of its files are enough.
+            if event.is_directory:
+                src_rel_path = os.path.relpath(event.src_path,
+                                               self.project_path)
+                dest_rel_path = os.path.relpath(event.dest_path,
+                                                self.project_path)
+                if not self.exclude(src_rel_path) and \
+                        not self.exclude(dest_rel_path):
+                    FileEvent(project, FileEvent.MOVE, src_rel_path,
+                              dest_path=dest_rel_path).register()
+                return
+
             src_rel_path = self._verify_exclude(event, event.src_path)
             dest_rel_path = self._verify_exclude(event, event.dest_path)
 
-            if src_rel_path:
+            if src_rel_path and dest_rel_path:
+                # The file is renamed server-side, its content is kept.
+                FileEvent(project, FileEvent.MOVE, src_rel_path,
+                          dest_path=dest_rel_path).register()
+            elif src_rel_path:
                 FileEvent(project, FileEvent.DELETE, src_rel_path).register()
-
-            if dest_rel_path:
+            elif dest_rel_path:
                 FileEvent(project, FileEvent.MODIF, dest_rel_path).register()
 
     def on_modified(self, event):
@@ -129,6 +175,13 @@ class EventHandler(FileSystemEventHandler):
             self.logger.debug("Ignore the file: %s" % rel_path)
             return
 
+        # Ignore the large files skipped by the policy of the project.
+        project = self._get_project(fullpath)
+        if project and policy.get_policy(project).get_action(rel_path) == \
+                policy.SKIP:
+            self.logger.debug("Skip the large file: %s" % rel_path)
+            return
+
         return rel_path
 
     def _get_project(self, fullpath):
@@ -144,7 +197,8 @@ class EventHandler(FileSystemEventHandler):
 @logger
 class Dancer(Thread):
     """ A thread that wakes up every <sleeptime> secs and starts a
-    rsync + merge verification if pending set() is not empty.
+    rsync + merge verification if pending set() is not empty. The atomic
+    saves of the editors are collapsed by the normalizer first.
     """
 
     def __init__(self, sleeptime=1):
@@ -155,6 +209,8 @@ class Dancer(Thread):
 
         self.sleeptime = sleeptime
         self.stop = False
+        self.normalizer = Normalizer(window=float(config['server'].get(
+            'atomic_save_window', 2)))
 
     def run(self):
         """ Runs the thread.
@@ -165,7 +221,15 @@ class Dancer(Thread):
             sleep(self.sleeptime)
 
             with lock:
-                for project, files in pending.iteritems():
+                # The projects with pending files or with files held by the
+                # normalizer.
+                projects = set(pending.keys()) | set(self.normalizer.held)
+                for project in projects:
+                    files = self.normalizer.normalize(
+                        project, pending.get(project, []))
+                    if not files:
+                        continue
+
                     try:
                         eventbus.fire('new-rsync', project=project,
                                       files=files)
@@ -198,16 +262,21 @@ class Monitor(object):
         # the value is the monitor instance.
         self.monitors = {}
 
+        # Keys -> project name, Values -> the event handler of the project.
+        # Each one has the exclude patterns of its own project.
+        self.handlers = {}
+
         try:
             # Avoid to use iteritems (python 2.x) or items (python 3.x) in
             # order to support both versions.
             for project in sorted(config['projects']):
                 project_attrs = config['projects'][project]
                 project_path = os.path.expanduser(project_attrs['path'])
-                self.handler = EventHandlerGit(project_path)
+                handler = EventHandlerGit(project_path)
+                self.handlers[project] = handler
 
                 monitor = Observer()
-                monitor.schedule(self.handler, project_path, recursive=True)
+                monitor.schedule(handler, project_path, recursive=True)
 
                 self.monitors[project_path] = monitor
         except OSError as err:
@@ -243,7 +312,7 @@ class Monitor(object):
 
                 # Register a FileEvent.MODIF if the file is not excluded
                 # and the file is more recent than the last rsync.
-                if not self.handler.exclude(rel_path) and \
+                if not self.handlers[project].exclude(rel_path) and \
                         cur_timestamp > register_timestamp:
 
                     FileEvent(project, FileEvent.MODIF, rel_path).register()
@@ -0,0 +1,159 @@
+import os
+import time
+import fnmatch
+
+from baboon.common.file import FileEvent
+from baboon.common.logger import logger
+
+# The temporary and backup files written by the editors when they save a file
+# (vim, emacs, JetBrains IDEs, gedit...).
+TEMP_PATTERNS = ['*.swp', '*.swx', '*.swo', '*~', '.#*', '#*#',
+                 '*___jb_tmp___', '*___jb_old___', '.goutputstream-*']
+
+# The names of the temporary files of some editors (vim, VS Code...) that a
+# user file can have too. They are temporary files only if they are written
+# and then deleted or renamed in the same save.
+SAVE_PATTERNS = ['4913', '*.tmp.*']
+
+
+def is_temp(path):
+    """ Returns True if the path is a temporary file of an editor.
+    """
+
+    return _match(path, TEMP_PATTERNS)
+
+
+def is_save_temp(path):
+    """ Returns True if the path is maybe a temporary file of an editor,
+    depending on its events.
+    """
+
+    return _match(path, SAVE_PATTERNS)
+
+
+def _match(path, patterns):
+    """ Returns True if the basename of the path matches one of the
+    patterns.
+    """
+
+    basename = os.path.basename(path)
+    for pattern in patterns:
+        if fnmatch.fnmatch(basename, pattern):
+            return True
+
+    return False
+
+
+@logger
+class Normalizer(object):
+    """ Collapses the atomic saves of the editors into a single modification
+    of the saved file. An editor writes a temporary file and renames it over
+    the original one (or renames the original one to a backup and writes it
+    again). The events on the temporary files are dropped.
+
+    If a file is renamed to a backup without being written again, the save
+    is maybe in progress. The events of the project are held until the next
+    tick, at most window secs.
+    """
+
+    def __init__(self, window=2):
+        """ Initializes the normalizer. A window of 0 disables it.
+        """
+
+        self.window = window
+
+        # Keys -> project name, Values -> (timestamp, held file events).
+        self.held = {}
+
+    def normalize(self, project, files):
+        """ Returns the normalized list of the files to sync now.
+        """
+
+        if not self.window:
+            return files
+
+        held_since, held = self.held.pop(project, (None, []))
+        files = held + files
+        if not files:
+            return []
+
+        now = time.time()
+        events, replaced = self._collapse(files)
+        if replaced:
+            if held_since is None or now - held_since < self.window:
+                self.held[project] = (held_since or now, files)
+                return []
+
+            # The files have really been renamed to a temporary name.
+            for path in replaced:
+                events.append(FileEvent(project, FileEvent.DELETE, path))
+
+        return events
+
+    def _collapse(self, files):
+        """ Returns the list of the normalized file events and the set of the
+        paths renamed to a backup but not written again.
+        """
+
+        events = []
+        replaced = set()
+        transient = self._transient(files)
+
+        for i, f in enumerate(files):
+            src_temp = is_temp(f.src_path) or i in transient
+
+            if f.event_type == FileEvent.MOVE:
+                dest_temp = is_temp(f.dest_path)
+
+                if src_temp and not dest_temp:
+                    # A temporary file renamed over the saved file.
+                    self.logger.debug('Atomic save of %s.' % f.dest_path)
+                    replaced.discard(f.dest_path)
+                    events.append(FileEvent(f.project, FileEvent.MODIF,
+                                            f.dest_path))
+                elif dest_temp and not src_temp:
+                    # The saved file kept as a backup. It will be written
+                    # again.
+                    replaced.add(f.src_path)
+                elif not src_temp:
+                    events.append(f)
+            elif src_temp:
+                # Never sync the temporary files.
+                continue
+            elif f.event_type == FileEvent.CREATE and f.src_path in replaced:
+                # The saved file written again after its backup.
+                self.logger.debug('Atomic save of %s.' % f.src_path)
+                replaced.discard(f.src_path)
+                events.append(FileEvent(f.project, FileEvent.MODIF,
+                                        f.src_path))
+            else:
+                if f.src_path in replaced:
+                    replaced.discard(f.src_path)
+                events.append(f)
+
+        return events, replaced
+
+    def _transient(self, files):
+        """ Returns the set of the indexes of the events on the files named
+        like a temporary file (see SAVE_PATTERNS) that are written and then
+        deleted or renamed in the files. A file written and kept is a file of
+        the user.
+        """
+
+        # Keys -> path, Values -> the indexes of its write events since its
+        # last deletion or renaming.
+        written = {}
+        transient = set()
+
+        for i, f in enumerate(files):
+            if not is_save_temp(f.src_path):
+                continue
+
+            if f.event_type in (FileEvent.CREATE, FileEvent.MODIF):
+                written.setdefault(f.src_path, []).append(i)
+            elif f.src_path in written:
+                # Deleted or renamed (e.g. over the saved file).
+                transient.update(written.pop(f.src_path))
+                transient.add(i)
+
+        return transient
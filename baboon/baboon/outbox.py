@@ -0,0 +1,107 @@
+import os
+import shelve
+
+from threading import Lock
+
+from baboon.common.file import FileEvent, EventBatch
+from baboon.common.logger import logger
+
+
+@logger
+class Outbox(object):
+    """ A persisted queue of the file events not yet synced by a lane of a
+    project. The events are stored in a shelve in the project metadir until
+    they're acknowledged, so they survive disconnections and restarts. The
+    queue is compacted (superseded events dropped) when it's opened.
+    """
+
+    # Compact the queue on ack when it contains more entries than this.
+    COMPACT_THRESHOLD = 1000
+
+    def __init__(self, project, metadir_path, name):
+        """ Opens (and compacts) the name outbox of the project.
+        """
+
+        self.project = project
+        self.path = os.path.join(metadir_path, 'outbox-%s' % name)
+        self._lock = Lock()
+
+        self.shelf = shelve.open(self.path)
+        self.seq = 0
+
+        with self._lock:
+            self._compact()
+
+    def put(self, files):
+        """ Appends the files to the queue.
+        """
+
+        with self._lock:
+            for f in files:
+                self.seq += 1
+                self.shelf['%012d' % self.seq] = (f.event_type, f.src_path,
+                                                  f.dest_path)
+            self.shelf.sync()
+
+    def mark(self):
+        """ Returns the sequence number of the last queued event. Used to
+        acknowledge all the events queued until now.
+        """
+
+        with self._lock:
+            return self.seq
+
+    def ack(self, mark):
+        """ Removes all the events queued until the mark.
+        """
+
+        with self._lock:
+            for key in self.shelf.keys():
+                if int(key) <= mark:
+                    del self.shelf[key]
+
+            if len(self.shelf) > self.COMPACT_THRESHOLD:
+                self._compact()
+
+            self.shelf.sync()
+
+    def get_events(self):
+        """ Returns the list of the queued FileEvent.
+        """
+
+        with self._lock:
+            return self._get_batch().get_events()
+
+    def close(self):
+        """ Closes the shelve.
+        """
+
+        with self._lock:
+            self.shelf.close()
+
+    def _get_batch(self):
+        """ Returns the EventBatch of the queued events. The lock must be held.
+        """
+
+        batch = EventBatch()
+        for key in sorted(self.shelf.keys()):
+            event_type, src_path, dest_path = self.shelf[key]
+            batch.add(FileEvent(self.project, event_type, src_path,
+                                dest_path=dest_path))
+
+        return batch
+
+    def _compact(self):
+        """ Rewrites the queue without the superseded events. The lock must be
+        held.
+        """
+
+        events = self._get_batch().get_events()
+
+        self.shelf.clear()
+        for seq, f in enumerate(events):
+            self.shelf['%012d' % (self.seq + seq + 1)] = (f.event_type,
+                                                          f.src_path,
+                                                          f.dest_path)
+        self.seq += len(events)
+        self.shelf.sync()
@@ -9,6 +9,7 @@ if sys.version_info < (2, 7):
 else:
     from functools import cmp_to_key
 
+from baboon.baboon import universe
 from baboon.baboon.monitor import EventHandler
 from baboon.common.errors.baboon_exception import BaboonException
 
@@ -20,6 +21,11 @@ class EventHandlerGit(EventHandler):
         # My ignore file name is...
         self.gitignore_path = os.path.join(project_path, '.gitignore')
 
+        # If the universe of the project is given by git, the gitignore
+        # regexps are not used.
+        self.universe = universe.get_universe(
+            self._get_project(project_path))
+
         # Lists of compiled RegExp objects
         self.include_regexps = []
         self.exclude_regexps = []
@@ -37,6 +43,12 @@ class EventHandlerGit(EventHandler):
         if rel_path == self.gitignore_path:
             self._populate_gitignore_items()
 
+        # Ask git if the file is ignored. The baboon files and the git locks
+        # are always excluded.
+        if self.universe:
+            return not self.universe.contains(rel_path) or \
+                self._match_excl_regexp(rel_path)
+
         # Return True only if rel_path matches an exclude pattern AND does NOT
         # match an include pattern. Else, return False
         if (self._match_excl_regexp(rel_path) and
@@ -55,6 +67,10 @@ class EventHandlerGit(EventHandler):
             # Reparse the gitignore.
             self._populate_gitignore_items()
 
+        # Any .gitignore file changes the universe given by git.
+        if self.universe and os.path.basename(rel_path) == '.gitignore':
+            self.universe.refresh()
+
         super(EventHandlerGit, self).on_modified(event)
 
     def _populate_gitignore_items(self):
@@ -68,8 +84,9 @@ class EventHandlerGit(EventHandler):
                                 re.compile('.*\.baboon-timestamp'),
                                 re.compile('.*baboon.*')]
 
-        # If there's a .gitignore file in the watched directory.
-        if os.path.exists(self.gitignore_path):
+        # If there's a .gitignore file in the watched directory and git does
+        # not give the universe of the project.
+        if os.path.exists(self.gitignore_path) and not self.universe:
             # Parse the gitignore.
             ignores = self._parse_gitignore()
             if ignores is not None:
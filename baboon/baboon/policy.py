@@ -0,0 +1,123 @@
+import os
+import time
+import fnmatch
+
+from threading import Lock
+
+from baboon.baboon.config import config
+from baboon.common.errors.baboon_exception import ConfigException
+
+# The actions available for the large files.
+SYNC = 'sync'
+SKIP = 'skip'
+DEFER = 'defer'
+BACKGROUND = 'background'
+ACTIONS = (SKIP, DEFER, BACKGROUND)
+
+
+class LargeFilePolicy(object):
+    """ The large file policy of a project. A file is large if it matches one
+    of the large_file_patterns globs or if it's bigger than
+    large_file_threshold bytes. A large file is either skipped (never synced),
+    deferred (synced when the project is idle) or synced in the background
+    lane (optionally rate-limited).
+
+    The policy is configured in the project section of the baboonrc:
+    large_file_threshold, large_file_patterns, large_file_policy,
+    large_file_rate and idle_delay.
+    """
+
+    def __init__(self, project, project_attrs):
+        """ Initializes the policy from the project_attrs config dict.
+        """
+
+        self.project = project
+        self.project_path = os.path.expanduser(project_attrs['path'])
+
+        # The threshold defaults to the global background threshold.
+        self.threshold = int(project_attrs.get(
+            'large_file_threshold', config.get('server', {}).get(
+                'background_threshold', 1048576)))
+
+        self.patterns = [x.strip() for x in project_attrs.get(
+            'large_file_patterns', '').split(',') if x.strip()]
+
+        self.action = project_attrs.get('large_file_policy', BACKGROUND)
+        if self.action not in ACTIONS:
+            raise ConfigException("The large_file_policy of %s must be one of "
+                                  "%s." % (project, ', '.join(ACTIONS)))
+
+        # The maximum number of bytes/sec sent by the background lane. 0
+        # means unlimited.
+        self.rate = int(project_attrs.get('large_file_rate', 0))
+
+        # The number of secs without any file event before syncing the
+        # deferred files.
+        self.idle_delay = int(project_attrs.get('idle_delay', 30))
+
+    def get_action(self, rel_path):
+        """ Returns the action (SYNC, SKIP, DEFER or BACKGROUND) for the
+        rel_path file.
+        """
+
+        return self.action if self.is_large(rel_path) else SYNC
+
+    def is_large(self, rel_path):
+        """ Returns True if the rel_path file matches a large file pattern or
+        is bigger than the threshold.
+        """
+
+        basename = os.path.basename(rel_path)
+        for pattern in self.patterns:
+            if fnmatch.fnmatch(rel_path, pattern) or \
+                    fnmatch.fnmatch(basename, pattern):
+                return True
+
+        if not self.threshold:
+            return False
+
+        try:
+            fullpath = os.path.join(self.project_path, rel_path)
+            return os.path.getsize(fullpath) > self.threshold
+        except EnvironmentError:
+            return False
+
+
+class RateLimiter(object):
+    """ Limits the throughput to rate bytes/sec by sleeping the caller.
+    """
+
+    def __init__(self, rate):
+
+        self.rate = rate
+        self.next_time = time.time()
+        self._lock = Lock()
+
+    def consume(self, nbytes):
+        """ Waits until nbytes can be sent.
+        """
+
+        with self._lock:
+            now = time.time()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + \
+                float(nbytes) / self.rate
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+# Keys -> project name, Values -> LargeFilePolicy.
+_policies = {}
+
+
+def get_policy(project):
+    """ Returns the LargeFilePolicy of the project.
+    """
+
+    policy = _policies.get(project)
+    if not policy:
+        policy = LargeFilePolicy(project, config['projects'][project])
+        _policies[project] = policy
+
+    return policy
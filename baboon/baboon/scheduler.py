@@ -0,0 +1,649 @@
+import os
+import time
+
+from threading import Thread, Event, Lock, RLock, Condition
+from threading import BoundedSemaphore, Timer
+
+from baboon.baboon import policy
+from baboon.baboon.config import config
+from baboon.baboon.initializor import MetadirController
+from baboon.baboon.outbox import Outbox
+from baboon.common import gitrefs
+from baboon.common.file import FileEvent, EventBatch, is_under
+from baboon.common.eventbus import eventbus
+from baboon.common.logger import logger
+
+# The sync lanes of a project. The background lane syncs the large files
+# without delaying the other ones.
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+
+# The name of the outbox of the deferred files.
+DEFERRED = 'deferred'
+
+# The number of seconds to wait before syncing again a batch that failed
+# while connected (timeout, busy server...).
+RETRY_DELAY = 5
+
+
+@logger
+class SyncSession(Thread):
+    """ A thread that syncs the batches of files of one project, one after
+    another. Each session has its own in-flight state and, if possible, its
+    own bytestream. Sessions of different projects run concurrently.
+
+    The files submitted while a sync is in-flight are coalesced (superseded
+    events are dropped) and sent in exactly one follow-up batch when the
+    current sync is finished.
+
+    The submitted files are persisted in the outbox of the session until
+    their sync succeeds or is rejected by the server. If the connection is
+    lost during a sync or if the sync times out, the batch is synced again
+    (once reconnected).
+    """
+
+    def __init__(self, scheduler, project, lane=INTERACTIVE):
+        """ Initializes the session of the lane of the project.
+        """
+
+        Thread.__init__(self, name='SyncSession-%s-%s' % (project, lane))
+
+        self.daemon = True
+        self.scheduler = scheduler
+        self.transport = scheduler.transport
+        self.project = project
+        self.lane = lane
+        self.timeout = scheduler.timeouts[lane]
+        self.outbox = scheduler.get_outbox(project, lane)
+
+        # The SID of the bytestream used by this session and the connection
+        # generation it belongs to. Negotiated again after a reconnection.
+        self.sid = None
+        self.generation = None
+
+        # The files waiting for the next sync.
+        self.pending = EventBatch()
+        self.pending_cond = Condition()
+        self.stop = False
+
+        # The rsync flags of the in-flight sync.
+        self.rsync_running = Event()
+        self.rsync_finished = Event()
+        self.rsync_finished.set()
+        self.failed = False
+
+        # True if the in-flight sync failed but must be retried (lost
+        # connection, timeout...), i.e. it was not rejected by the server.
+        self.retry = False
+
+        # The RIDs of the rsync stanzas of the in-flight sync.
+        self.rids = []
+
+        # The number of rsync stanzas of the in-flight step not yet finished
+        # by the server and whether it's the last step of the sync.
+        self.remaining = 0
+        self.last_step = True
+        self._lock = Lock()
+
+        # The paths of the in-flight sync.
+        self.inflight_paths = set()
+
+    def submit(self, files, persist=True):
+        """ Adds the files to the next batch to sync. If persist is False,
+        the files are already in the outbox.
+        """
+
+        with self.pending_cond:
+            if persist:
+                self.outbox.put(files)
+            self.pending.extend(files)
+            self.pending_cond.notify()
+
+    def forget(self, file_event):
+        """ Forgets the paths deleted or moved by the file_event, synced by
+        another lane. The pending events on them are dropped, except the
+        modifications of a moved path that become modifications of its
+        destination. An in-flight path is deleted (or synced again at its
+        destination) by the next sync.
+        """
+
+        moved = file_event.event_type == FileEvent.MOVE
+
+        def dest(path):
+            return file_event.dest_path + path[len(file_event.src_path):]
+
+        with self.pending_cond:
+            events, added = [], []
+            for f in self.pending.get_events():
+                if not is_under(f.src_path, file_event.src_path):
+                    events.append(f)
+                elif moved and f.event_type in (FileEvent.CREATE,
+                                                FileEvent.MODIF):
+                    added.append(FileEvent(f.project, FileEvent.MODIF,
+                                           dest(f.src_path)))
+
+            for path in self.inflight_paths:
+                if not is_under(path, file_event.src_path):
+                    continue
+
+                added.append(FileEvent(self.project, FileEvent.DELETE, path))
+                if moved:
+                    added.append(FileEvent(self.project, FileEvent.MODIF,
+                                           dest(path)))
+
+            # Nothing to forget.
+            if len(events) == len(self.pending) and not added:
+                return
+
+            if added:
+                self.outbox.put(added)
+            self.pending = EventBatch()
+            self.pending.extend(events + added)
+            self.pending_cond.notify()
+
+    def close(self):
+        """ Stops the session once the current batch is synced.
+        """
+
+        with self.pending_cond:
+            self.stop = True
+            self.pending_cond.notify()
+
+    def run(self):
+        """ Syncs the queued batches one after another.
+        """
+
+        while True:
+            # Wait for files to sync and take all of them.
+            with self.pending_cond:
+                while not len(self.pending) and not self.stop:
+                    self.pending_cond.wait()
+
+                if self.stop:
+                    break
+
+                files = self.pending.get_events()
+                mark = self.outbox.mark()
+                self.pending = EventBatch()
+                self.inflight_paths = set([x.src_path for x in files])
+
+            # Wait for the connection and (re)negotiate the bytestream if
+            # needed.
+            self.transport.connected.wait()
+            if self.generation != self.transport.generation:
+                self._open_stream()
+
+            # The small and text files first.
+            files = self.scheduler.prioritize(self.project, files)
+
+            # Limit the number of concurrent syncs of all projects.
+            with self.scheduler.slots:
+                success = self._sync(files)
+
+            if success or not self.retry:
+                # Done (or rejected by the server, retrying is useless).
+                self.outbox.ack(mark)
+            else:
+                # Sync the batch again (before the files submitted since),
+                # once reconnected if the connection is lost.
+                self.logger.warning('[%s] The sync failed. It will be '
+                                    'resumed.' % self.project)
+                self._requeue(files)
+
+                if self.transport.connected.is_set():
+                    time.sleep(RETRY_DELAY)
+
+    def expect(self, rids):
+        """ Registers the RIDs of the rsync stanzas sent for the in-flight
+        sync.
+        """
+
+        with self._lock:
+            self.remaining += len(rids)
+            self.rids += rids
+
+        self.scheduler.register_rids(rids, self)
+
+    def on_rsync_finished(self):
+        """ Called when the server has finished a rsync stanza. Returns True
+        if the whole in-flight sync is finished.
+        """
+
+        with self._lock:
+            self.remaining -= 1
+            if self.remaining > 0:
+                return False
+
+        self.rsync_finished.set()
+        return self.last_step
+
+    def on_rsync_error(self, retry=False):
+        """ Called when the in-flight sync failed. If retry is True, the
+        failure is not a rejection of the server and the batch will be synced
+        again.
+        """
+
+        if retry:
+            self.retry = True
+        self.failed = True
+        self.rsync_finished.set()
+
+    def _open_stream(self):
+        """ Negotiates the bytestream of the session.
+        """
+
+        self.generation = self.transport.generation
+        if self.scheduler.stream_per_project:
+            self.sid = self.transport.open_stream()
+        else:
+            self.sid = self.transport.sid
+
+        # Limit the throughput of the background lane if it has its own
+        # bytestream.
+        rate = policy.get_policy(self.project).rate
+        if self.lane == BACKGROUND and rate and self.sid != self.transport.sid:
+            self.transport.rate_limiters[self.sid] = policy.RateLimiter(rate)
+
+    def _requeue(self, files):
+        """ Puts the files back in front of the pending files.
+        """
+
+        with self.pending_cond:
+            batch = EventBatch()
+            batch.extend(files)
+            batch.extend(self.pending.get_events())
+            self.pending = batch
+
+    def _sync(self, files):
+        """ Syncs the files and waits until the server has finished. Returns
+        True on success.
+        """
+
+        # The refs and objects of the .git directory are synced by object id,
+        # before the other files.
+        git_files, others = [], []
+        for f in files:
+            if self.scheduler.is_git_object(self.project, f):
+                git_files.append(f)
+            else:
+                others.append(f)
+
+        # Set the rsync flags.
+        self.failed = False
+        self.retry = False
+        self.rsync_running.set()
+
+        try:
+            if git_files:
+                self._step(self.transport.git_sync, last_step=not others)
+            if others and not self.failed:
+                self._step(self.transport.rsync, others)
+        finally:
+            self.rsync_running.clear()
+            self.rsync_finished.set()
+            self.inflight_paths = set()
+
+            # A late answer of the server to this sync must not be counted in
+            # the next one.
+            with self._lock:
+                self.scheduler.forget_rids(self.rids)
+                self.rids = []
+
+        if not self.failed:
+            eventbus.fire('rsync-finished-success', self.project, files)
+
+        return not self.failed
+
+    def _step(self, send, *args, **kwargs):
+        """ Runs a step of the in-flight sync with the send method of the
+        transport and waits until the server has finished it.
+        """
+
+        self.remaining = 0
+        self.last_step = kwargs.get('last_step', True)
+        self.rsync_finished.clear()
+
+        send(self.project, *args, session=self)
+
+        self.rsync_finished.wait(self.timeout)
+        if not self.rsync_finished.is_set():
+            self.logger.error('[%s] Timeout on sync detected !' %
+                              self.project)
+            self.on_rsync_error(retry=True)
+
+
+@logger
+class Scheduler(object):
+    """ Dispatches the syncs to the sessions of each project and limits the
+    number of concurrent syncs.
+
+    The large modified files are handled according to the LargeFilePolicy of
+    the project: skipped, deferred until the project is idle or synced in the
+    background lane of the project, with its own session, bytestream and
+    timeout. The other files are ordered by priority: deletions and creations
+    first, then the text files and the binary files, smallest first.
+    """
+
+    def __init__(self, transport):
+        """ Initializes the scheduler of the transport.
+        """
+
+        self.transport = transport
+
+        # Keys -> (project name, lane), Values -> The associated SyncSession.
+        # A new session opens its outbox with the lock already held.
+        self.sessions = {}
+        self._lock = RLock()
+
+        # Keys -> RID of the in-flight rsync stanzas, Values -> SyncSession.
+        self.rids = {}
+
+        # Keys -> project name, Values -> the EventBatch of the deferred files
+        # and the Timer to sync them when the project is idle.
+        self.deferred = {}
+        self.idle_timers = {}
+
+        # Keys -> (project name, outbox name), Values -> Outbox.
+        self.outboxes = {}
+
+        # The maximum number of concurrent syncs for all projects.
+        self.slots = BoundedSemaphore(int(config['server'].get(
+            'max_concurrent_syncs', 4)))
+
+        # If True, each session negotiates its own bytestream.
+        self.stream_per_project = bool(int(config['server'].get(
+            'stream_per_project', 1)))
+
+        # The maximum number of seconds to wait for the end of a sync of each
+        # lane.
+        self.timeouts = {
+            INTERACTIVE: int(config['server'].get('sync_timeout', 600)),
+            BACKGROUND: int(config['server'].get('background_timeout', 3600)),
+        }
+
+    def resume(self):
+        """ Resumes the syncs persisted in the outboxes of all projects (i.e.
+        not finished before the last exit).
+        """
+
+        for project, project_attrs in config['projects'].iteritems():
+            # The project is not yet initialized.
+            project_path = os.path.expanduser(project_attrs['path'])
+            if not os.path.exists(os.path.join(project_path,
+                                               MetadirController.METADIR)):
+                continue
+
+            for lane in (INTERACTIVE, BACKGROUND):
+                files = self.get_outbox(project, lane).get_events()
+                if files:
+                    self.logger.info("[%s] Resume the sync of %d file(s)." %
+                                     (project, len(files)))
+                    self.get_session(project, lane).submit(files,
+                                                           persist=False)
+
+            files = self.get_outbox(project, DEFERRED).get_events()
+            self._defer(project, files, persist=False)
+
+    def get_outbox(self, project, name):
+        """ Returns the name outbox of the project. If the outbox is not yet
+        opened, it will be opened.
+        """
+
+        with self._lock:
+            outbox = self.outboxes.get((project, name))
+            if not outbox:
+                project_path = os.path.expanduser(
+                    config['projects'][project]['path'])
+                metadir_path = os.path.join(project_path,
+                                            MetadirController.METADIR)
+                outbox = Outbox(project, metadir_path, name)
+                self.outboxes[(project, name)] = outbox
+
+            return outbox
+
+    def submit(self, project, files):
+        """ Dispatches the files to the sessions of the project.
+        """
+
+        interactive, background, deferred = [], [], []
+        for f in files:
+            action = self._get_action(project, f)
+            if action == policy.SKIP:
+                self.logger.debug("[%s] Skip the large file %s." %
+                                  (project, f.src_path))
+            elif action == policy.DEFER:
+                deferred.append(f)
+            elif action == policy.BACKGROUND and \
+                    f.event_type in (FileEvent.CREATE, FileEvent.MODIF):
+                background.append(f)
+            else:
+                # The deletions and the moves are synced by the interactive
+                # lane only. The background lane forgets their paths (e.g. a
+                # large file deleted during its sync).
+                interactive.append(f)
+
+                session = self.sessions.get((project, BACKGROUND))
+                if session and f.event_type in (FileEvent.DELETE,
+                                                FileEvent.MOVE):
+                    session.forget(f)
+
+        if interactive:
+            self.get_session(project).submit(interactive)
+        if background:
+            self.get_session(project, BACKGROUND).submit(background)
+
+        if deferred:
+            self._defer(project, deferred)
+        else:
+            # The project is not idle. No need to touch the outbox.
+            with self._lock:
+                self._restart_idle_timer(project)
+
+    def prioritize(self, project, files):
+        """ Returns the files ordered by priority. The events are never
+        reordered across a MOVE event.
+        """
+
+        project_path = os.path.expanduser(config['projects'][project]['path'])
+
+        ordered = []
+        segment = []
+        for f in files + [None]:
+            if f is None or f.event_type == FileEvent.MOVE:
+                segment.sort(key=lambda x: self._get_priority(project_path, x))
+                ordered += segment
+                segment = []
+                if f is not None:
+                    ordered.append(f)
+            else:
+                segment.append(f)
+
+        return ordered
+
+    def get_session(self, project, lane=INTERACTIVE):
+        """ Returns the session of the lane of the project. If the session
+        does not exist, it will be created and started.
+        """
+
+        with self._lock:
+            session = self.sessions.get((project, lane))
+            if not session:
+                session = SyncSession(self, project, lane=lane)
+                self.sessions[(project, lane)] = session
+                session.start()
+
+            return session
+
+    def register_rids(self, rids, session):
+        """ Associates the RIDs of the rsync stanzas to the session.
+        """
+
+        with self._lock:
+            for rid in rids:
+                self.rids[rid] = session
+
+    def forget_rids(self, rids):
+        """ Forgets the RIDs of the rsync stanzas of a finished sync.
+        """
+
+        with self._lock:
+            for rid in rids:
+                self.rids.pop(rid, None)
+
+    def fail_all(self):
+        """ Fails all the in-flight syncs right away. Called when the
+        connection is lost, the batches will be synced again once reconnected.
+        """
+
+        for session in self.sessions.values():
+            if session.rsync_running.is_set():
+                session.on_rsync_error(retry=True)
+
+    def rsync_finished(self, project, rid=None):
+        """ Called when the server has finished the rid rsync stanza of the
+        project. Returns True if the whole sync is finished.
+        """
+
+        with self._lock:
+            if rid:
+                session = self.rids.pop(rid, None)
+            else:
+                session = self.sessions.get((project, INTERACTIVE))
+
+        if rid and not session:
+            # The answer to a sync already failed (e.g. timeout).
+            self.logger.debug("[%s] Unknown rid %s." % (project, rid))
+            return False
+
+        if not session:
+            self.logger.error("No sync session for the project %s." % project)
+            return False
+
+        return session.on_rsync_finished()
+
+    def is_running(self):
+        """ Returns True if a sync is in-flight for any project.
+        """
+
+        return any([x.rsync_running.is_set() for x in self.sessions.values()])
+
+    def wait(self):
+        """ Waits until all in-flight syncs are finished.
+        """
+
+        for session in self.sessions.values():
+            session.rsync_finished.wait()
+
+    def close(self):
+        """ Stops all the sessions and the idle timers and closes the
+        outboxes.
+        """
+
+        for timer in self.idle_timers.values():
+            timer.cancel()
+
+        for session in self.sessions.values():
+            session.close()
+
+        for session in self.sessions.values():
+            session.join(5)
+
+        for outbox in self.outboxes.values():
+            outbox.close()
+
+    def is_git_object(self, project, file_event):
+        """ Returns True if the file_event is synced by object id, i.e. it's
+        a ref or an object of the .git directory of a project with the
+        'objects' git_sync mode.
+        """
+
+        project_attrs = config['projects'][project]
+        if project_attrs.get('scm', 'git') != 'git' or \
+                project_attrs.get('git_sync', 'objects') != 'objects':
+            return False
+
+        return gitrefs.is_object_path(file_event.src_path) or \
+            (file_event.dest_path is not None and
+             gitrefs.is_object_path(file_event.dest_path))
+
+    def _get_action(self, project, file_event):
+        """ Returns the policy action for the file_event.
+        """
+
+        # The git objects are never transferred as files.
+        if file_event.event_type != FileEvent.MODIF or \
+                self.is_git_object(project, file_event):
+            return policy.SYNC
+
+        return policy.get_policy(project).get_action(file_event.src_path)
+
+    def _defer(self, project, files, persist=True):
+        """ Adds the files to the deferred files of the project and
+        (re)starts the idle timer of the project. The deferred files are
+        synced in the background lane when no file event is submitted during
+        idle_delay secs.
+        """
+
+        outbox = self.get_outbox(project, DEFERRED)
+        with self._lock:
+            if persist:
+                outbox.put(files)
+
+            batch = self.deferred.setdefault(project, EventBatch())
+            batch.extend(files)
+            self._restart_idle_timer(project)
+
+    def _restart_idle_timer(self, project):
+        """ (Re)starts the idle timer of the project if it has deferred
+        files. The lock must be held.
+        """
+
+        batch = self.deferred.get(project)
+        if not batch:
+            return
+
+        timer = self.idle_timers.get(project)
+        if timer:
+            timer.cancel()
+
+        timer = Timer(policy.get_policy(project).idle_delay,
+                      self._on_idle, args=(project, ))
+        timer.daemon = True
+        self.idle_timers[project] = timer
+        timer.start()
+
+    def _on_idle(self, project):
+        """ Called when the project is idle. Syncs the deferred files.
+        """
+
+        outbox = self.get_outbox(project, DEFERRED)
+        with self._lock:
+            files = self.deferred.pop(project, EventBatch()).get_events()
+            mark = outbox.mark()
+            self.idle_timers.pop(project, None)
+
+        if files:
+            self.logger.info("[%s] Idle, sync %d deferred file(s)." %
+                             (project, len(files)))
+            self.get_session(project, BACKGROUND).submit(files)
+
+        # The files are now in the outbox of the background lane.
+        outbox.ack(mark)
+
+    def _get_priority(self, project_path, file_event):
+        """ Returns the sort key of the file_event: deletions and creations
+        first, then the text files and the binary files, smallest first.
+        """
+
+        if file_event.event_type != FileEvent.MODIF:
+            return (0, 0)
+
+        fullpath = os.path.join(project_path, file_event.src_path)
+        try:
+            size = os.path.getsize(fullpath)
+            with open(fullpath, 'rb') as fd:
+                is_binary = '\0' in fd.read(1024)
+        except EnvironmentError:
+            return (0, 0)
+
+        return (2 if is_binary else 1, size)
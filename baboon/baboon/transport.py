@@ -1,27 +1,34 @@
 import os
-import sys
 import pickle
 import struct
 import uuid
 import time
+import zlib
 
-from threading import Event
+from threading import Event, Lock
 
 from sleekxmpp import ClientXMPP
 from sleekxmpp.jid import JID
 from sleekxmpp.xmlstream.handler import Callback
 from sleekxmpp.xmlstream.matcher import StanzaPath
 from sleekxmpp.xmlstream.tostring import tostring
-from sleekxmpp.exceptions import IqError
+from sleekxmpp.exceptions import IqError, IqTimeout
 from sleekxmpp.plugins.xep_0060.stanza.pubsub_event import EventItem
 
-from baboon.baboon.monitor import FileEvent
+from baboon.baboon import policy
+from baboon.baboon.monitor import FileEvent, create_tarball
+from baboon.common.file import is_under
 from baboon.baboon.config import config
+from baboon.baboon.scheduler import Scheduler
 from baboon.common import proxy_socket
+from baboon.common import manifest
+from baboon.common import gitrefs
+from baboon.common.dataplane import dataplane
 from baboon.common.eventbus import eventbus
 from baboon.common.logger import logger
 from baboon.common import pyrsync
 from baboon.common.stanza import rsync
+from baboon.common.stats import stats
 from baboon.common.errors.baboon_exception import BaboonException
 
 
@@ -37,8 +44,6 @@ class CommonTransport(ClientXMPP):
 
         self.connected = Event()
         self.disconnected = Event()
-        self.rsync_running = Event()
-        self.rsync_finished = Event()
         self.wait_close = False
         self.failed_auth = False
 
@@ -67,11 +72,6 @@ class CommonTransport(ClientXMPP):
         self.add_event_handler('message', self.message)
         self.add_event_handler('message_form', self.message_form)
         self.add_event_handler('message_xform', self.message_form)
-        self.register_handler(Callback('RsyncFinished Handler',
-                                       StanzaPath('iq@type=set/rsyncfinished'),
-                                       self._handle_rsync_finished))
-
-        eventbus.register('new-rsync', self._on_new_rsync)
 
     def __enter__(self):
         """ Adds the support of with statement with all CommonTransport
@@ -172,34 +172,6 @@ class CommonTransport(ClientXMPP):
             self.logger.debug("Received pubsub event: \n%s" %
                               msg['pubsub_event'])
 
-    def _on_new_rsync(self, project, files, **kwargs):
-        """ Called when a new rsync needs to be started.
-        """
-
-        self.connected.wait()
-
-        self.rsync(project, files=files)
-        eventbus.fire('rsync-finished-success', project, files)
-
-    def _handle_rsync_finished(self, iq):
-        """ Called when a rsync is finished.
-        """
-
-        # Retrieve the project context.
-        node = iq['rsyncfinished']['node']
-
-        # Reply to the iq.
-        self.logger.debug("[%s] Sync finished." % node)
-        iq.reply().send()
-
-        # Set the rsync flags.
-        self.rsync_running.clear()
-        self.rsync_finished.set()
-
-        # It's time to verify if there's a conflict or not.
-        if not self.wait_close:
-            self.merge_verification(node)
-
     def message_form(self, form):
         self.logger.debug("Received a form message: %s" % form)
         try:
@@ -219,16 +191,6 @@ class CommonTransport(ClientXMPP):
     def message(self, msg):
         self.logger.info("Received: %s" % msg)
 
-    def rsync_error(self, msg):
-        """ On rsync error.
-        """
-
-        self.logger.error(msg)
-
-        # Set the rsync flags.
-        self.rsync_running.clear()
-        self.rsync_finished.set()
-
 
 @logger
 class WatchTransport(CommonTransport):
@@ -247,10 +209,66 @@ class WatchTransport(CommonTransport):
         # Shortcuts to access to the config server information
         self.streamer_addr = config['server']['streamer']
 
+        # If the data plane is enabled, all the bytestreams are handled by
+        # a single event loop instead of a thread by socket.
+        self.use_dataplane = bool(int(config['server'].get('dataplane', 0)))
+        dataplane.workers = int(config['server'].get('dataplane_workers', 4))
+
+        # If the binary manifest is enabled, the list of files is sent over
+        # the bytestream instead of the rsync stanza.
+        self.binary_manifest = config['server'].get('manifest') == 'binary'
+
+        # The modified files smaller than inline_threshold bytes are sent
+        # compressed in the rsync request. 0 disables it.
+        self.inline_threshold = int(config['server'].get('inline_threshold',
+                                                         0))
+
+        # The created files carry their content: inline up to
+        # create_inline_threshold bytes, streamed over the bytestream in
+        # chunks of stream_chunk_size bytes otherwise. The large files are
+        # synced as before. 0 disables it.
+        self.create_inline_threshold = int(config['server'].get(
+            'create_inline_threshold', 65536))
+        self.stream_chunk_size = int(config['server'].get(
+            'stream_chunk_size', 524288))
+
+        # The created and modified files of the batches with at least
+        # bulk_threshold of them are sent in a gzipped tarball streamed over
+        # the bytestream. 0 disables it.
+        self.bulk_threshold = int(config['server'].get('bulk_threshold', 200))
+
+        # If True, the git blob id of the other modified files is sent first.
+        # The server uses its own copy of the blob if it already has it.
+        self.blob_ids = bool(int(config['server'].get('blob_ids', 1)))
+
         self.register_plugin('xep_0050')  # Ad-hoc command
         self.register_plugin('xep_0065')  # Socks5 Bytestreams
 
         self.add_event_handler('socks_connected', self._on_socks_connected)
+        self.register_handler(Callback('RsyncFinished Handler',
+                                       StanzaPath('iq@type=set/rsyncfinished'),
+                                       self._handle_rsync_finished))
+
+        # The SID of the main bytestream. Negotiated at session start. The
+        # generation is incremented at each (re)connection.
+        self.sid = None
+        self.generation = 0
+
+        # The syncs of each project are run by the scheduler.
+        self.scheduler = Scheduler(self)
+
+        # Keys -> SID, Values -> Event set when the bytestream is listened.
+        self.streams = {}
+        self.streams_lock = Lock()
+
+        # Keys -> SID, Values -> the RateLimiter of the bytestream.
+        self.rate_limiters = {}
+
+        self.add_event_handler('disconnected', self._on_disconnected)
+        eventbus.register('new-rsync', self._on_new_rsync)
+
+        # Resume the syncs not finished before the last exit.
+        self.scheduler.resume()
 
     def start(self, event):
         """ Handler for the session_start sleekxmpp event.
@@ -281,133 +299,480 @@ class WatchTransport(CommonTransport):
         # good proxy_socket stored in self.streamer.proxy_threads dict.
         self.sid = streamhost_used['socks']['sid']
 
-    def _on_socks_connected(self, event):
-        """
+    def _on_socks_connected(self, sid):
+        """ Called when a Socks5 bytestream is connected.
         """
 
-        proxy_sock = self.streamer.get_socket(self.sid)
-        proxy_listener = proxy_socket.listen(self.sid, proxy_sock,
-                                             self._on_socks5_data)
+        self._listen(sid)
+
+        # A bytestream negotiated by a sync session.
+        if sid != self.sid:
+            return
 
         self.logger.debug("Connected.")
+        self.generation += 1
         self.connected.set()
 
         # Retrieve the list of pending users.
         for project in config['projects']:
             self._get_pending_users(project)
 
+    def _on_disconnected(self, event):
+        """ Called when the XMPP connection is lost. The in-flight syncs
+        fail right away and the sync sessions wait until the connection is
+        established again to sync them again.
+        """
+
+        self.connected.clear()
+        self.rate_limiters.clear()
+        self.scheduler.fail_all()
+
     def close(self):
         """ Closes the XMPP connection.
         """
 
         # Wait until all syncs are finished.
         self.wait_close = True
-        if self.rsync_running.is_set():
+        if self.scheduler.is_running():
             self.logger.info("A sync task is currently running...")
-            self.rsync_finished.wait()
+            self.scheduler.wait()
             self.logger.info("Ok, all syncs are now finished.")
+        self.scheduler.close()
 
         # Close the proxy proxy_socket.
+        if self.use_dataplane:
+            dataplane.close()
         if hasattr(self, 'streamer') and self.streamer:
             self.streamer.close()
 
         # Disconnect...
         super(WatchTransport, self).close()
 
-    def rsync(self, project, files=None):
-        """ Starts a rsync transaction, rsync and stop the
-        transaction.
+    def open_stream(self):
+        """ Negotiates a new bytestream and returns its SID once it's
+        listened. Returns the SID of the main bytestream on error.
+        """
+
+        try:
+            streamhost_used = self.streamer.handshake(self.server_addr,
+                                                      self.streamer_addr)
+            sid = streamhost_used['socks']['sid']
+        except IqError as e:
+            self.logger.warning("Cannot establish a new bytestream (%s). Use "
+                                "the main one." % e.iq['error']['text'])
+            return self.sid
+
+        if not self._get_stream_event(sid).wait(10):
+            self.logger.warning("The bytestream %s is not connected. Use the "
+                                "main one." % sid)
+            return self.sid
+
+        return sid
+
+    def _on_new_rsync(self, project, files, **kwargs):
+        """ Called when a new rsync needs to be started. The files are synced
+        by the sync session of the project.
+        """
+
+        self.scheduler.submit(project, files)
 
-        Raises a BaboonException if there's a problem.
+    def _handle_rsync_finished(self, iq):
+        """ Called when a rsync is finished.
+        """
+
+        # Retrieve the project context.
+        node = iq['rsyncfinished']['node']
+
+        # Reply to the iq.
+        self.logger.debug("[%s] Sync finished." % node)
+        iq.reply().send()
+
+        # It's time to verify if there's a conflict or not, once all the
+        # stanzas of the sync are finished.
+        rid = iq['rsyncfinished']['rid']
+        stats.request_finished(rid)
+        if self.scheduler.rsync_finished(node, rid) and not self.wait_close:
+            self.merge_verification(node)
+
+    def rsync_error(self, session, msg, retry=False):
+        """ On rsync error. If retry is True, the sync will be retried,
+        i.e. it's not a rejection of the server.
+        """
+
+        self.logger.error(msg)
+        session.on_rsync_error(retry=retry)
+
+    def rsync(self, project, files, session):
+        """ Starts a rsync transaction of the files over the bytestream of
+        the session. The session is notified when the rsync is finished.
         """
 
         # Verify if the connection is established. Otherwise, wait...
         if not self.connected.is_set():
             self.connected.wait()
 
-        # Set the rsync flags.
-        self.rsync_running.set()
-        self.rsync_finished.clear()
-
         #TODO: make this an int while checking config file
         max_stanza_size = int(config['server']['max_stanza_size'])
 
-        # Build first stanza
-        iq = self._build_iq(project, files)
-
         try:
-            # Get the size of the stanza
-            to_xml = tostring(iq.xml)
-            size = sys.getsizeof(to_xml)
-
-            # If it's bigger than the max_stanza_size, split it !
-            if size >= max_stanza_size:
-                iqs = self._split_iq(size, project, files)
-                self.logger.warning('The xml stanza has been split %s stanzas.'
-                                    % len(iqs))
+            # Forget the contents attached by a previous attempt.
+            for f in files:
+                f.content, f.oid, f.streamed = None, None, False
+
+            # Send the created and modified files in a tarball if there's a
+            # lot of them.
+            files, bulk = self._select_bulk(project, files)
+
+            # Attach the content of the created files and of the small
+            # modified files to the request and the blob id of the other ones.
+            files = self._attach_create_contents(project, files)
+            self._inline_contents(project, files)
+            self._attach_blob_ids(project, files)
+
+            # The name of the upload of the tarball, referenced by the first
+            # stanza.
+            bulk_name = str(uuid.uuid4()) if bulk else None
+
+            if self.binary_manifest:
+                # A single control stanza, the files are in the manifest.
+                iqs = [self._build_manifest_iq(project, files, session,
+                                               bulk=bulk_name)]
             else:
-                # Else the original iq will be the only element to send
-                iqs = [iq]
+                # Pack the files into as few stanzas as possible.
+                iqs = self._build_iqs(project, files, session,
+                                      max_stanza_size, bulk=bulk_name)
+            session.expect([x['rsync']['rid'] for x in iqs])
+
+            if len(iqs) > 1:
+                self.logger.warning('The file list has been split in %s '
+                                    'stanzas.' % len(iqs))
+
+            # The streamed contents are sent before the stanzas. The server
+            # waits for them if needed.
+            if bulk:
+                self._stream_bulk(project, bulk, bulk_name, session)
+            self._stream_files(project, files, session)
 
             # Send elements in list
-            for iq in iqs:
+            for i, iq in enumerate(iqs):
+                stats.request_started(iq['rsync']['rid'])
                 iq.send()
-                self.logger.debug('Sent (%d/%d)!' %
-                                  (iqs.index(iq) + 1, len(iqs)))
+                self.logger.debug('Sent (%d/%d)!' % (i + 1, len(iqs)))
 
         except IqError as e:
-            self.rsync_error(e.iq['error']['text'])
+            # A busy server (wait error) did not reject the sync. It will be
+            # retried.
+            self.rsync_error(session, e.iq['error']['text'],
+                             retry=e.iq['error']['type'] == 'wait')
         except Exception as e:
-            self.rsync_error(e)
+            # Not a rejection of the server (e.g. a lost connection).
+            self.rsync_error(session, e, retry=True)
+
+    def git_sync(self, project, session):
+        """ Syncs the refs of the .git directory of the project over the
+        bytestream of the session. Only the objects missing server-side are
+        sent, in a bundle. The session is notified when the sync is finished.
+        """
+
+        # Verify if the connection is established. Otherwise, wait...
+        if not self.connected.is_set():
+            self.connected.wait()
+
+        project_path = os.path.expanduser(config['projects'][project]['path'])
+
+        try:
+            # Get the refs of the server-side repository.
+            iq = self.Iq(sto=self.server_addr, stype='get')
+            iq['git-sync']['node'] = project
+            haves = [x[1] for x in iq.send()['git-sync']['refs']]
+
+            # Bundle the objects reachable from the local refs but not from
+            # the server-side ones.
+            refs = gitrefs.get_refs(project_path)
+            bundle = gitrefs.create_bundle(project_path, refs, haves)
+
+            iq = self.Iq(sto=self.server_addr, stype='set')
+            iq['git-sync']['sid'] = session.sid
+            iq['git-sync']['rid'] = str(uuid.uuid4())
+            iq['git-sync']['node'] = project
+            iq['git-sync']['refs'] = refs
+            session.expect([iq['git-sync']['rid']])
+
+            # The bundle is sent before the stanza. The server waits for it if
+            # the stanza is received first.
+            if bundle is not None:
+                iq['git-sync']['bundle'] = 'yes'
+                self.send_frame(session.sid, {
+                    'node': project,
+                    'rid': iq['git-sync']['rid'],
+                    'bundle': bundle,
+                })
+
+            stats.request_started(iq['git-sync']['rid'])
+            iq.send()
+        except IqError as e:
+            # A busy server (wait error) did not reject the sync. It will be
+            # retried.
+            self.rsync_error(session, e.iq['error']['text'],
+                             retry=e.iq['error']['type'] == 'wait')
+        except Exception as e:
+            # Not a rejection of the server (e.g. a lost connection).
+            self.rsync_error(session, e, retry=True)
+
+    def _attach_create_contents(self, project, files):
+        """ Attaches the compressed content of each created file (or marks
+        it as streamed if it's bigger than create_inline_threshold bytes). The
+        server writes it at once instead of creating an empty file and
+        syncing it. Returns the files without the modifications of the files
+        created with their content. The modifications of the large or
+        unreadable created files are kept.
+        """
+
+        if not self.create_inline_threshold:
+            return files
+
+        project_path = os.path.expanduser(config['projects'][project]['path'])
+        large_file_policy = policy.get_policy(project)
+
+        ret = []
+        created = set()
+        for f in files:
+            # The content sent with the creation is read now.
+            if f.event_type == FileEvent.MODIF and f.src_path in created:
+                continue
+
+            created.discard(f.src_path)
+            if f.dest_path:
+                created.discard(f.dest_path)
+            ret.append(f)
+
+            if f.event_type != FileEvent.CREATE or \
+                    large_file_policy.is_large(f.src_path):
+                continue
+
+            fullpath = os.path.join(project_path, f.src_path)
+            try:
+                if os.path.getsize(fullpath) <= self.create_inline_threshold:
+                    with open(fullpath, 'rb') as fd:
+                        f.content = zlib.compress(fd.read())
+                else:
+                    f.streamed = True
+                created.add(f.src_path)
+            except EnvironmentError:
+                # The file is maybe already deleted. Create an empty file.
+                f.content = None
+
+        return ret
+
+    def _select_bulk(self, project, files):
+        """ Returns the files to send one by one and the paths of the
+        created and modified files to send in a tarball, if there's at least
+        bulk_threshold of them. The large files and the paths of the moves
+        (the order matters) are never in the tarball.
+        """
+
+        if not self.bulk_threshold:
+            return files, []
+
+        large_file_policy = policy.get_policy(project)
+        moves = [x for x in files if x.event_type == FileEvent.MOVE]
+
+        bulk = []
+        for f in files:
+            if f.event_type not in (FileEvent.CREATE, FileEvent.MODIF) or \
+                    large_file_policy.is_large(f.src_path):
+                continue
+
+            if [x for x in moves if is_under(f.src_path, x.src_path) or
+                    is_under(f.src_path, x.dest_path)]:
+                continue
+
+            # A file can be created and modified in the same batch.
+            if f.src_path not in bulk:
+                bulk.append(f.src_path)
+
+        if len(bulk) < self.bulk_threshold:
+            return files, []
+
+        bulk_paths = set(bulk)
+        return [x for x in files if x.src_path not in bulk_paths or
+                x.event_type not in (FileEvent.CREATE, FileEvent.MODIF)], bulk
+
+    def _stream_bulk(self, project, bulk, name, session):
+        """ Streams the tarball of the bulk files as the name upload over
+        the bytestream of the session.
+        """
+
+        project_path = os.path.expanduser(config['projects'][project]['path'])
+        tarball, added = create_tarball(project_path, bulk)
+
+        self.logger.info('[%s] Send %d file(s) in a tarball.' %
+                         (project, len(added)))
+        with tarball:
+            self._stream_upload(project, name, tarball, session)
+
+    def _stream_files(self, project, files, session):
+        """ Streams the compressed content of the streamed created files
+        over the bytestream of the session, chunk by chunk.
+        """
+
+        project_path = os.path.expanduser(config['projects'][project]['path'])
+        for f in [x for x in files if x.streamed]:
+            try:
+                with open(os.path.join(project_path, f.src_path), 'rb') as fd:
+                    self._stream_upload(project, f.src_path, fd, session)
+            except EnvironmentError as err:
+                # The file is maybe already deleted. The next event will fix
+                # it. Always end the upload, the server is waiting for it.
+                self.logger.warning(err)
+                self._stream_upload(project, f.src_path, None, session)
+
+    def _stream_upload(self, project, name, fd, session):
+        """ Sends the content of the fd file object as the name upload over
+        the bytestream of the session, chunk by chunk. The last frame ends the
+        upload.
+        """
+
+        payload = {
+            'from': self.boundjid.bare,
+            'node': project,
+            'upload': name,
+        }
+
+        while fd:
+            chunk = fd.read(self.stream_chunk_size)
+            if not chunk:
+                break
+
+            payload['data'] = zlib.compress(chunk)
+            payload['eof'] = False
+            self.send_frame(session.sid, payload)
+
+        payload['data'] = ''
+        payload['eof'] = True
+        self.send_frame(session.sid, payload)
+
+    def _inline_contents(self, project, files):
+        """ Attaches the compressed content of each modified file smaller
+        than inline_threshold bytes. The server applies them directly without
+        any hash/delta exchange.
+        """
+
+        if not self.inline_threshold:
+            return
 
-    def _build_iq(self, project, files):
-        """Build a single rsync stanza.
+        project_path = os.path.expanduser(config['projects'][project]['path'])
+        for f in files:
+            if f.event_type != FileEvent.MODIF:
+                continue
+
+            fullpath = os.path.join(project_path, f.src_path)
+            try:
+                if os.path.getsize(fullpath) <= self.inline_threshold:
+                    with open(fullpath, 'rb') as fd:
+                        f.content = zlib.compress(fd.read())
+            except EnvironmentError:
+                # The file is maybe already deleted. Let the normal sync
+                # handle it.
+                f.content = None
+
+    def _attach_blob_ids(self, project, files):
+        """ Attaches the git blob id of each modified file not sent inline.
+        If the server-side repository already has the blob (e.g. after a
+        branch switch), it's written without any hash/delta exchange.
+        """
+
+        project_attrs = config['projects'][project]
+        if not self.blob_ids or project_attrs.get('scm', 'git') != 'git':
+            return
+
+        modified = [x for x in files if x.event_type == FileEvent.MODIF and
+                    x.content is None]
+        if not modified:
+            return
+
+        project_path = os.path.expanduser(project_attrs['path'])
+        oids = gitrefs.hash_objects(project_path,
+                                    [x.src_path for x in modified])
+
+        # A file is maybe already deleted. Let the normal sync handle it.
+        if oids is None:
+            return
+
+        for f, oid in zip(modified, oids):
+            f.oid = oid
+
+    def _build_iq(self, project, session):
+        """ Build a single rsync stanza of the session without any file.
         """
         iq = self.Iq(sto=self.server_addr, stype='set')
 
         # Generate a new rsync ID.
-        iq['rsync']['sid'] = self.sid
+        iq['rsync']['sid'] = session.sid
         iq['rsync']['rid'] = str(uuid.uuid4())
         iq['rsync']['node'] = project
+        iq['rsync']['lane'] = session.lane
 
-        for f in files:
-            if f.event_type == FileEvent.MODIF:
-                iq['rsync'].add_file(f.src_path)
-            elif f.event_type == FileEvent.CREATE:
-                iq['rsync'].add_create_file(f.src_path)
-            elif f.event_type == FileEvent.DELETE:
-                iq['rsync'].add_delete_file(f.src_path)
+        return iq
+
+    def _build_manifest_iq(self, project, files, session, bulk=None):
+        """ Sends the binary manifest of the files over the bytestream of the
+        session and returns the rsync stanza referencing it (and the bulk
+        tarball upload, if any).
+        """
+
+        iq = self._build_iq(project, session)
+        iq['rsync']['manifest'] = 'binary'
+        if bulk:
+            iq['rsync']['bulk'] = bulk
+
+        # The manifest is sent before the stanza. The server waits for it if
+        # the stanza is received first.
+        self.send_frame(session.sid, {
+            'node': project,
+            'rid': iq['rsync']['rid'],
+            'manifest': manifest.pack(files),
+        })
 
         return iq
 
-    def _split_iq(self, size, project, files):
-        """Splits a stanza into multiple stanzas whith size < max_stanza_size.
-        Returns a list a stanzas
+    def _build_iqs(self, project, files, session, max_stanza_size,
+                   bulk=None):
+        """ Packs the files into rsync stanzas in one pass. Each stanza is
+        filled with files until its encoded size reaches max_stanza_size.
+        The first stanza references the bulk tarball upload, if any. Returns
+        the list of stanzas.
         """
 
-        iqs = []
+        iqs = [self._build_iq(project, session)]
 
-        # We don't need the exact result of the division. Let's add 1 to
-        # overcome "round" issues. How many chunks do we need ?
-        chunk_num = size / int(config['server']['max_stanza_size']) + 1
+        # The size of the stanza without any file is the same for all
+        # stanzas of the session (the rid is always an uuid4). The closing
+        # tag of the rsync element is added once there's a file inside.
+        empty_size = rsync.encoded_size(tostring(iqs[0].xml)) + \
+            len('</rsync>')
+        size = empty_size
+        nb_files = 0
 
-        # How many files per chunk then ?
-        step = len(files) / chunk_num
+        # The bulk attribute takes room in the first stanza only.
+        if bulk:
+            iqs[0]['rsync']['bulk'] = bulk
+            size = rsync.encoded_size(tostring(iqs[0].xml)) + len('</rsync>')
 
-        # Get the splitted files list
-        chunks = list(self._get_chunks(files, step))
+        for f in files:
+            file_size = rsync.file_element_size(f)
 
-        # Build a stanza for each of them
-        for chunk in chunks:
-            iqs.append(self._build_iq(project, chunk))
+            # The current stanza is full. Start a new one.
+            if nb_files and size + file_size > max_stanza_size:
+                iqs.append(self._build_iq(project, session))
+                size = empty_size
+                nb_files = 0
 
-        return iqs
+            iqs[-1]['rsync'].add_event(f)
+            size += file_size
+            nb_files += 1
 
-    def _get_chunks(self, files, step):
-        """ Generate the chunks from the files list.
-        """
-        for i in xrange(0, len(files), step):
-            yield files[i:i + step]
+        return iqs
 
     def _on_socks5_data(self, sid, data, **kwargs):
         """ Called when receiving data over the socks5 proxy_socket (xep
@@ -442,9 +807,13 @@ class WatchTransport(CommonTransport):
             fullpath = os.path.join(project_path, relpath)
             if os.path.exists(fullpath) and os.path.isfile(fullpath):
                 # Computes the local delta of the current file.
+                start = time.time()
                 patchedfile = open(fullpath, 'rb')
                 delta = pyrsync.rsyncdelta(patchedfile, hashes,
                                            blocksize=8192)
+                stats.observe(data['node'], 'delta', time.time() - start)
+                stats.delta(data['node'], relpath,
+                            os.path.getsize(fullpath), delta)
                 delta = (relpath, delta)
 
                 # Appends the result to the list of delta.
@@ -457,7 +826,45 @@ class WatchTransport(CommonTransport):
         ret['delta'] = deltas
 
         # Sends the result over the proxy_socket.
-        self.streamer.send(sid, proxy_socket.pack(ret))
+        self.send_frame(sid, ret)
+
+    def send_frame(self, sid, payload):
+        """ Packs and sends the payload dict over the bytestream associated
+        to the sid.
+        """
+
+        packed = proxy_socket.pack(payload)
+        stats.frame_out(sid, payload.get('node'), len(packed))
+
+        # Wait if the bytestream is rate-limited.
+        rate_limiter = self.rate_limiters.get(sid)
+        if rate_limiter:
+            rate_limiter.consume(len(packed))
+
+        if self.use_dataplane:
+            dataplane.send(sid, packed)
+        else:
+            self.streamer.send(sid, packed)
+
+    def _listen(self, sid):
+        """ Starts listening for data on the bytestream associated to the
+        sid.
+        """
+
+        proxy_sock = self.streamer.get_socket(sid)
+        if self.use_dataplane:
+            dataplane.register(sid, proxy_sock, self._on_socks5_data)
+        else:
+            proxy_socket.listen(sid, proxy_sock, self._on_socks5_data)
+
+        self._get_stream_event(sid).set()
+
+    def _get_stream_event(self, sid):
+        """ Returns the Event set when the sid bytestream is listened.
+        """
+
+        with self.streams_lock:
+            return self.streams.setdefault(sid, Event())
 
     def merge_verification(self, project):
         """ Sends an IQ to verify if there's a conflict or not.
@@ -470,6 +877,9 @@ class WatchTransport(CommonTransport):
             iq.send()
         except IqError as e:
             self.logger.error(e.iq['error']['text'])
+        except IqTimeout:
+            self.logger.error("[%s] Timeout on the merge verification." %
+                              project)
 
     def _get_pending_users(self, node):
         """ Build and send the message to get the list of pending users on the
@@ -0,0 +1,140 @@
+import os
+import subprocess
+
+from os.path import join, relpath, lexists
+from threading import Lock
+
+from baboon.baboon.config import config
+from baboon.common.logger import logger
+from baboon.common.errors.baboon_exception import ConfigException
+
+# The ways to find the files to sync of a project: walk the whole project
+# directory or ask git.
+WALK = 'walk'
+GIT = 'git'
+MODES = (WALK, GIT)
+
+
+@logger
+class GitUniverse(object):
+    """ The files to sync of a project, given by git itself: the tracked files
+    and the untracked files not ignored (ls-files with the standard excludes),
+    plus the .git directory. The ignored directories (build directories,
+    virtualenvs, node_modules...) are never walked.
+
+    The universe is enabled with universe = git in the project section of the
+    baboonrc.
+    """
+
+    def __init__(self, project_path):
+        """ Initializes the universe of the git repository at project_path.
+        """
+
+        self.project_path = project_path
+        self._lock = Lock()
+        self.refresh()
+
+    def refresh(self):
+        """ Asks git for the tracked, untracked and ignored paths. Called again
+        when a .gitignore file changes.
+        """
+
+        paths = set(self._ls_files() +
+                    self._ls_files('--others', '--exclude-standard'))
+        ignored = self._ls_files('--others', '--ignored', '--exclude-standard',
+                                 '--directory')
+
+        with self._lock:
+            self.paths = paths
+            self.ignored = set([x for x in ignored if not x.endswith('/')])
+            self.ignored_dirs = tuple([x for x in ignored if x.endswith('/')])
+
+    def get_files(self):
+        """ Returns the relative paths of the existing files of the universe.
+        """
+
+        with self._lock:
+            files = [x for x in self.paths if
+                     lexists(join(self.project_path, x))]
+
+        # The .git directory is not listed by git.
+        git_dir = join(self.project_path, '.git')
+        for root, _, names in os.walk(git_dir):
+            for name in names:
+                files.append(relpath(join(root, name), self.project_path))
+
+        return files
+
+    def contains(self, rel_path):
+        """ Returns True if the rel_path file needs to be synced.
+        """
+
+        if rel_path == '.git' or rel_path.startswith('.git/'):
+            return True
+
+        with self._lock:
+            if rel_path in self.paths:
+                return True
+
+            if rel_path in self.ignored or \
+                    rel_path.startswith(self.ignored_dirs):
+                return False
+
+        # A new file. Ask git and remember the answer.
+        ignored = self._check_ignore(rel_path)
+        with self._lock:
+            (self.ignored if ignored else self.paths).add(rel_path)
+
+        return not ignored
+
+    def _ls_files(self, *args):
+        """ Returns the list of paths given by git ls-files with args.
+        """
+
+        proc = subprocess.Popen(['git', 'ls-files', '-z'] + list(args),
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                cwd=self.project_path)
+        output, errors = proc.communicate()
+        if proc.returncode:
+            self.logger.error("Cannot list the files of %s: %s" %
+                              (self.project_path, errors))
+            return []
+
+        return [x for x in output.split('\0') if x]
+
+    def _check_ignore(self, rel_path):
+        """ Returns True if git ignores the rel_path file.
+        """
+
+        proc = subprocess.Popen(['git', 'check-ignore', '-q', '--', rel_path],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                cwd=self.project_path)
+        proc.communicate()
+
+        return proc.returncode == 0
+
+
+# Keys -> project name, Values -> GitUniverse.
+_universes = {}
+
+
+def get_universe(project):
+    """ Returns the GitUniverse of the project or None if the files of the
+    project are found by walking its directory.
+    """
+
+    project_attrs = config['projects'][project]
+    mode = project_attrs.get('universe', WALK)
+    if mode not in MODES:
+        raise ConfigException("The universe of %s must be one of %s." %
+                              (project, ', '.join(MODES)))
+
+    if mode == WALK:
+        return None
+
+    universe = _universes.get(project)
+    if not universe:
+        universe = GitUniverse(os.path.expanduser(project_attrs['path']))
+        _universes[project] = universe
+
+    return universe
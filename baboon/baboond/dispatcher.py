@@ -1,46 +1,349 @@
+import heapq
+import itertools
+
+from threading import Lock, Condition
+
 from executor import Executor
 
+from baboon.baboond.config import config
 from baboon.common.logger import logger
+from baboon.common.workerpool import WorkerPool
 from baboon.common.errors.baboon_exception import BaboonException
+from baboon.common.errors.baboon_exception import ConfigException
+
+# The ways to run the tasks: a thread by project or a fixed-size pool of
+# workers shared by all the projects.
+THREADS = 'threads'
+POOL = 'pool'
+MODES = (THREADS, POOL)
+
+
+class RWLock(object):
+    """ A lock held by many readers or by a single writer. A waiting writer
+    blocks the new readers so it's never starved.
+    """
+
+    def __init__(self):
+
+        self._cond = Condition(Lock())
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    def acquire_read(self):
+        """ Waits until there's no writer, then holds the lock shared.
+        """
+
+        with self._cond:
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+
+    def try_acquire_read(self):
+        """ Holds the lock shared if there's no writer. Returns False
+        otherwise, without waiting.
+        """
+
+        with self._cond:
+            if self._writer or self._waiting_writers:
+                return False
+
+            self._readers += 1
+            return True
+
+    def release_read(self):
+
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        """ Waits until there's no reader nor writer, then holds the lock
+        exclusively.
+        """
+
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+
+    def try_acquire_write(self, waiting=False):
+        """ Holds the lock exclusively if there's no reader nor writer.
+        Returns False otherwise, without waiting. The writer is then counted
+        as waiting (the new readers are refused) until it retries with
+        waiting=True and gets the lock.
+        """
+
+        with self._cond:
+            if self._writer or self._readers:
+                if not waiting:
+                    self._waiting_writers += 1
+                return False
+
+            if waiting:
+                self._waiting_writers -= 1
+            self._writer = True
+            return True
+
+    def release_write(self):
+
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+
+class GuardedTask(object):
+    """ Runs a task holding the RWLock of its project: shared for the tasks
+    of a user (they only write the directory of this user), exclusive for
+    the others (e.g. the MergeTask reads the directories of all the users).
+    A task without lock (the background syncs) is run as is.
+    """
+
+    def __init__(self, task, lock, exclusive):
+
+        self.task = task
+        self.priority = task.priority
+        self.lock = lock
+        self.exclusive = exclusive
+
+        # True if the task is counted as a waiting writer of the lock.
+        self.waiting = False
+
+    def __cmp__(self, other):
+        """ The comparison is based on the priority.
+        """
+        return cmp(self.priority, other.priority)
+
+    def run(self):
+        """ Waits for the lock, then runs the task.
+        """
+
+        if self.lock:
+            if self.exclusive:
+                self.lock.acquire_write()
+            else:
+                self.lock.acquire_read()
+
+        self.run_locked()
+
+    def try_acquire(self):
+        """ Takes the lock without waiting. Returns False if it's not
+        available.
+        """
+
+        if not self.lock:
+            return True
+
+        if not self.exclusive:
+            return self.lock.try_acquire_read()
+
+        acquired = self.lock.try_acquire_write(self.waiting)
+        self.waiting = not acquired
+        return acquired
+
+    def run_locked(self):
+        """ Runs the task and releases the lock already taken.
+        """
+
+        try:
+            self.task.run()
+        finally:
+            self.release()
+
+    def release(self):
+        """ Releases the lock taken by the task.
+        """
+
+        if not self.lock:
+            return
+
+        if self.exclusive:
+            self.lock.release_write()
+        else:
+            self.lock.release_read()
 
 
 @logger
 class Dispatcher(object):
     """ This class has the responsability to dispatch tasks to the good
     executor thread according to the project name.
+
+    The tasks of a user of a project (rsync, git sync, git init) have their
+    own lane. They run one after another, in parallel with the tasks of the
+    other users. The other tasks of the project (merge verification,
+    alerts) run in the lane of the project, alone.
+
+    The background syncs of a user (large files, rate limited) have a lane
+    of their own and never hold the lock of the project. A long transfer
+    delays neither the interactive syncs of the user nor the merge
+    verification. Their files are renamed in place once complete, a merge
+    verification never reads a partial file.
+
+    In pool mode, each lane has a queue of tasks instead of a thread. The
+    queues are consumed by a fixed-size pool of workers, one task of a lane
+    after another. An idle lane costs no thread. A worker never waits for the
+    lock of a project: a lane whose next task cannot take it is parked and
+    scheduled again when the lock is released.
     """
 
-    def __init__(self):
-        """
+    def __init__(self, mode=THREADS, workers=8):
+        """ Initializes the dispatcher in the mode (threads or pool). The
+        pool has workers threads.
         """
 
-        # Keys -> project name, Values -> The associated executor thread.
+        if mode not in MODES:
+            raise ConfigException("The dispatcher must be one of %s." %
+                                  ', '.join(MODES))
+
+        self.mode = mode
+
+        # Keys -> lane (the project name or a (project name, user) tuple),
+        # Values -> The associated executor thread.
         self.executors = {}
 
-    def put(self, project_name, task):
-        """ Put the task to the executor thread associated to the project name.
-        If the thread does not exist, it will be created.
+        # Keys -> lane, Values -> the heap of the pending (priority,
+        # sequence, task) of the lane (pool mode only).
+        self.queues = {}
+
+        # Keys -> project name, Values -> the RWLock of the project.
+        self.locks = {}
+
+        # Keys -> project name, Values -> {lane => number of runs to
+        # schedule again} of the lanes waiting for the lock of the project
+        # (pool mode only).
+        self.parked = {}
+        self._sequence = itertools.count()
+        self._lock = Lock()
+
+        self.pool = None
+        if mode == POOL:
+            self.pool = WorkerPool(workers, name='DispatcherWorker')
+            self.pool.start()
+
+    def put(self, project_name, task, user=None, background=False):
+        """ Put the task to the executor thread associated to the project name
+        (and to the user if any, and to the background lane of the user if
+        background is True). If the thread does not exist, it will be
+        created.
         """
 
-        # Get the executor thread associated to the project name.
-        executor = self.executors.get(project_name)
-        if not executor:
-            # The thread does not exist yet. Create a new one.
-            executor = Executor()
+        lane = (project_name, user) if user else project_name
+
+        with self._lock:
+            lock = self.locks.get(project_name)
+            if not lock:
+                lock = RWLock()
+                self.locks[project_name] = lock
+
+        if user and background:
+            lane = (project_name, user, 'background')
+            task = GuardedTask(task, None, exclusive=False)
+        elif task.exclusive:
+            # The task reads the directories of all the users.
+            task = GuardedTask(task, lock, exclusive=True)
+        elif user:
+            # The tasks of a user share the project.
+            task = GuardedTask(task, lock, exclusive=False)
+        else:
+            # The other tasks (e.g. the alerts) touch no user directory.
+            task = GuardedTask(task, None, exclusive=False)
+
+        if self.pool:
+            self._put_pool(lane, task)
+            return
+
+        # Get the executor thread associated to the lane. The tasks are put
+        # by many threads.
+        with self._lock:
+            executor = self.executors.get(lane)
+            if not executor:
+                # The thread does not exist yet. Create a new one.
+                executor = Executor()
 
-            # Associate this new thread to the project_name.
-            self.executors[project_name] = executor
+                # Associate this new thread to the lane.
+                self.executors[lane] = executor
 
-            # Start the thread.
-            executor.start()
+                # Start the thread.
+                executor.start()
 
         # Put the task to the good executor thread.
         executor.tasks.put(task)
 
+    def _put_pool(self, lane, task):
+        """ Queues the task of the lane and schedules a run of the next task
+        of the lane on the pool.
+        """
+
+        with self._lock:
+            queue = self.queues.setdefault(lane, [])
+
+            # The tasks with the same priority are run in the order they are
+            # put.
+            heapq.heappush(queue, (task.priority, next(self._sequence),
+                                   task))
+
+        # One run is scheduled by task. The runs of a lane are one after
+        # another.
+        self.pool.submit_ordered(lane, self._run_next, lane)
+
+    def _run_next(self, lane):
+        """ Runs the task of the lane with the highest priority (pool mode
+        only).
+        """
+
+        project_name = lane[0] if isinstance(lane, tuple) else lane
+
+        with self._lock:
+            queue = self.queues.get(lane)
+            if not queue:
+                # The dispatcher has been closed.
+                return
+
+            # Never wait for the lock of the project in a worker. The run is
+            # scheduled again when the lock is released.
+            task = queue[0][2]
+            if not task.try_acquire():
+                parked = self.parked.setdefault(project_name, {})
+                parked[lane] = parked.get(lane, 0) + 1
+                return
+
+            heapq.heappop(queue)
+            if not queue:
+                del self.queues[lane]
+
+        try:
+            self.logger.debug('Running a new task of %s...' % (lane,))
+            task.task.run()
+        except BaboonException as err:
+            self.logger.error(err)
+        finally:
+            # Release the lock and wake up the parked lanes atomically. A lane
+            # is never parked after the wake up of its lock.
+            with self._lock:
+                task.release()
+                parked = self.parked.pop(project_name, {})
+
+            for parked_lane, runs in parked.items():
+                for i in range(runs):
+                    self.pool.submit_ordered(parked_lane, self._run_next,
+                                             parked_lane)
+
     def close(self):
         """ Stop all executor threads.
         """
 
+        if self.pool:
+            # Drop the pending tasks and wait for the running ones.
+            with self._lock:
+                self.queues.clear()
+                self.parked.clear()
+
+            self.pool.close()
+            return
+
         from baboon.baboond.task import EndTask
 
         for executor in self.executors.values():
@@ -48,4 +351,5 @@ class Dispatcher(object):
             executor.join()
 
 
-dispatcher = Dispatcher()
+dispatcher = Dispatcher(config['server'].get('dispatcher', THREADS),
+                        int(config['server'].get('dispatcher_workers', 8)))
@@ -0,0 +1,96 @@
+import os
+
+from baboon.common.logger import logger
+from baboon.common.errors.baboon_exception import ConfigException
+
+# The durability modes of the written files: no fsync, a fsync of the files
+# and directories touched by a rsync at its end, or a fsync of each file.
+NONE = 'none'
+BATCH = 'batch'
+FILE = 'file'
+MODES = (NONE, BATCH, FILE)
+
+
+@logger
+class Durability(object):
+    """ Makes the files written by the syncs durable according to the mode.
+    Each file is written in a temporary file renamed over it. before_rename
+    and after_rename are called around the rename, and flush at the end of
+    the rsync with the paths collected by after_rename.
+    """
+
+    def __init__(self, mode=NONE):
+
+        self.mode = mode
+
+    def set_mode(self, mode):
+        """ Sets the durability mode. Raises a ConfigException if the mode is
+        unknown.
+        """
+
+        if mode not in MODES:
+            raise ConfigException("The durability must be one of %s." %
+                                  ', '.join(MODES))
+
+        self.mode = mode
+
+    def before_rename(self, fd):
+        """ Called with the temporary file object fd once written and before
+        it's renamed.
+        """
+
+        if self.mode == FILE:
+            fd.flush()
+            os.fsync(fd.fileno())
+
+    def after_rename(self, fullpath, touched=None):
+        """ Called once the temporary file is renamed to fullpath. In batch
+        mode, the fullpath is added to the touched set.
+        """
+
+        if self.mode == FILE:
+            _fsync_path(os.path.dirname(fullpath))
+        elif self.mode == BATCH and touched is not None:
+            touched.add(fullpath)
+
+    def flush(self, touched):
+        """ Syncs the touched files then their directories once. Called at
+        the end of a rsync.
+        """
+
+        if self.mode != BATCH or not touched:
+            return
+
+        dirs = set()
+        for fullpath in touched:
+            try:
+                _fsync_path(fullpath)
+            except EnvironmentError:
+                # The file has maybe been deleted or moved since.
+                pass
+
+            dirs.add(os.path.dirname(fullpath))
+
+        for dirpath in dirs:
+            try:
+                _fsync_path(dirpath)
+            except EnvironmentError:
+                pass
+
+        self.logger.debug('%d file(s) and %d directory(ies) synced.' %
+                          (len(touched), len(dirs)))
+        touched.clear()
+
+
+def _fsync_path(path):
+    """ Flushes the file or directory at path to the disk.
+    """
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+durability = Durability()
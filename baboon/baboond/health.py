@@ -0,0 +1,73 @@
+import os
+import subprocess
+
+from threading import Lock
+
+from baboon.common.file import is_under
+from baboon.common.logger import logger
+
+
+def is_git_path(rel_path):
+    """ Returns True if the rel_path is in the .git directory.
+    """
+
+    return is_under(rel_path, '.git')
+
+
+@logger
+class Health(object):
+    """ A cache of the health of the server-side repositories. A repository is
+    healthy if its HEAD commit and the tree of this commit can be read. The
+    health is checked once and kept until a sync touches the .git directory
+    of the repository or a git init clones it again.
+    """
+
+    def __init__(self):
+
+        # Keys -> repository path, Values -> True if the repository is
+        # healthy.
+        self.repos = {}
+        self._lock = Lock()
+
+    def is_healthy(self, repo_path):
+        """ Returns True if the repository at repo_path is healthy.
+        """
+
+        with self._lock:
+            healthy = self.repos.get(repo_path)
+
+        if healthy is None:
+            healthy = self._check(repo_path)
+            with self._lock:
+                self.repos[repo_path] = healthy
+
+        return healthy
+
+    def invalidate(self, repo_path):
+        """ Forgets the health of the repository at repo_path. It will be
+        checked again next time.
+        """
+
+        with self._lock:
+            self.repos.pop(repo_path, None)
+
+    def _check(self, repo_path):
+        """ Returns True if the HEAD commit and its tree are readable.
+        """
+
+        if not os.path.isdir(repo_path):
+            return False
+
+        proc = subprocess.Popen(['git', 'cat-file', '-e', 'HEAD^{tree}'],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, cwd=repo_path)
+        output, _ = proc.communicate()
+        if proc.returncode:
+            self.logger.warning('The repository %s is not healthy: %s' %
+                                (repo_path, output.strip()))
+            return False
+
+        return True
+
+
+health = Health()
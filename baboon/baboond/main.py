@@ -1,12 +1,20 @@
 from baboon.baboond.transport import transport
 from baboon.baboond.dispatcher import dispatcher
+from baboon.baboond.config import config
 from baboon.common.eventbus import eventbus
+from baboon.common.stats import StatsReporter
 
 
 def main():
     """ Initializes baboond.
     """
 
+    # If the stats interval is configured, periodically log the transfer
+    # statistics.
+    stats_interval = config['server'].get('stats_interval')
+    if stats_interval:
+        StatsReporter(int(stats_interval)).start()
+
     try:
         while not transport.disconnected.is_set():
             transport.disconnected.wait(5)
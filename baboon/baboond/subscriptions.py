@@ -0,0 +1,69 @@
+import time
+
+from threading import Lock
+
+from baboon.common.logger import logger
+
+
+@logger
+class Subscriptions(object):
+    """ A cache of the subscribers of the pubsub nodes. The authorization of
+    the stanzas is answered from memory instead of asking the pubsub service
+    each time. An entry expires after ttl secs and is invalidated as soon as a
+    subscription of its node changes.
+    """
+
+    def __init__(self, ttl=60):
+        """ Initializes the cache. A ttl of 0 disables it.
+        """
+
+        self.ttl = ttl
+        self._lock = Lock()
+
+        # Keys -> node, Values -> (timestamp, set of the subscribed bare
+        # jids).
+        self.nodes = {}
+
+    def get(self, node):
+        """ Returns the set of the subscribers of the node or None if they're
+        unknown or expired.
+        """
+
+        with self._lock:
+            entry = self.nodes.get(node)
+            if not entry:
+                return None
+
+            timestamp, jids = entry
+            if time.time() - timestamp >= self.ttl:
+                del self.nodes[node]
+                return None
+
+            return jids
+
+    def set(self, node, jids):
+        """ Remembers the jids list as the subscribers of the node.
+        """
+
+        if not self.ttl:
+            return
+
+        with self._lock:
+            self.nodes[node] = (time.time(), set(jids))
+
+    def invalidate(self, node=None):
+        """ Forgets the subscribers of the node (of all the nodes if node is
+        None).
+        """
+
+        with self._lock:
+            if node is None:
+                self.nodes.clear()
+            else:
+                self.nodes.pop(node, None)
+
+        self.logger.debug('Subscriptions of %s invalidated.' %
+                          (node or 'all the nodes'))
+
+
+subscriptions = Subscriptions()
@@ -6,17 +6,24 @@ import shutil
 import tempfile
 import uuid
 import re
+import time
+import tarfile
+import zlib
 
 from sleekxmpp.jid import JID
 
 from baboon.baboond.dispatcher import dispatcher
 from baboon.baboond.transport import transport
 from baboon.baboond.config import config
-from baboon.common import pyrsync, proxy_socket
+from baboon.baboond.health import health, is_git_path
+from baboon.baboond.durability import durability
+from baboon.common import pyrsync
+from baboon.common import gitrefs
 from baboon.common.utils import exec_cmd
 from baboon.common.eventbus import eventbus
 from baboon.common.file import FileEvent
 from baboon.common.logger import logger
+from baboon.common.stats import stats
 from baboon.common.errors.baboon_exception import BaboonException
 
 
@@ -38,6 +45,10 @@ class Task(object):
     """ The base class for all kind of tasks.
     """
 
+    # True if the task reads the directories of all the users of the
+    # project. It's never run beside their syncs.
+    exclusive = False
+
     def __init__(self, priority):
         """ Store the priority in order to compare tasks and order
         them.
@@ -143,6 +154,9 @@ class GitInitTask(Task):
         create_missing_dirs(self.project_cwd, isfile=False)
         ret_code, output, _ = exec_cmd('git clone %s %s' % (
             self.url, self.jid), self.project_cwd)
+
+        # The repository is a new one.
+        health.invalidate(self.user_cwd)
         if not ret_code:
             self.logger.debug('Git init task finished.')
             eventbus.fire('git-init-success', self.bid)
@@ -151,15 +165,91 @@ class GitInitTask(Task):
                           "Cannot initialize the git repository.")
 
 
+@logger
+class GitSyncTask(Task):
+    """ A task to sync the refs of the .git directory of the baboon client
+    repository. Only the objects missing server-side are received, in a
+    bundle.
+    """
+
+    def __init__(self, rid, sfrom, project, project_path, refs, bundle=False):
+
+        super(GitSyncTask, self).__init__(4)
+
+        self.rid = rid
+        self.jid = JID(sfrom)
+        self.project = project
+        self.project_path = project_path
+        self.refs = refs
+        self.bundle = None
+
+        # Declare a thread Event to wait until the bundle is received.
+        self.bundle_received = threading.Event()
+        if not bundle:
+            self.bundle_received.set()
+
+    def set_bundle(self, data):
+        """ Sets the bundle received over the bytestream.
+        """
+
+        self.bundle = data
+        self.bundle_received.set()
+
+    def run(self):
+
+        self.logger.debug('GitSyncTask %s started' % self.rid)
+
+        # Wait until the bundle is received (if any).
+        self.bundle_received.wait(240)
+        if not self.bundle_received.is_set():
+            self.logger.error('Timeout on the bundle of the git sync %s.' %
+                              self.rid)
+            eventbus.fire('rsync-finished-failure', rid=self.rid)
+            return
+
+        try:
+            # Store the missing objects, then move the refs.
+            if self.bundle is not None:
+                start = time.time()
+                gitrefs.unbundle(self.project_path, self.bundle)
+                stats.observe(self.project, 'unbundle', time.time() - start)
+
+            gitrefs.update_refs(self.project_path, self.refs)
+        except BaboonException as err:
+            self.logger.error(err)
+            eventbus.fire('rsync-finished-failure', rid=self.rid)
+            return
+        finally:
+            # The refs have maybe moved.
+            health.invalidate(self.project_path)
+
+        eventbus.fire('rsync-finished-success', rid=self.rid)
+
+        self.logger.debug('Git sync task %s finished', self.rid)
+
+
 @logger
 class RsyncTask(Task):
     """ A rsync task to sync the baboon client repository with
     relative repository server-side.
     """
 
-    def __init__(self, sid, rid, sfrom, project, project_path, files):
+    def __init__(self, sid, rid, sfrom, project, project_path, files,
+                 lane=None, bulk=None):
+
+        # The background lane syncs large files. It has a lower priority than
+        # the MergeTask in order to verify the merge of the other files as
+        # soon as possible.
+        background = lane == 'background'
+        super(RsyncTask, self).__init__(6 if background else 4)
 
-        super(RsyncTask, self).__init__(4)
+        # The background syncs have their own lane in the dispatcher.
+        self.background = background
+
+        # The maximum number of seconds to wait for each delta.
+        self.timeout = int(config['server'].get(
+            'background_timeout' if background else 'rsync_timeout',
+            3600 if background else 240))
 
         self.sid = sid
         self.rid = rid
@@ -168,6 +258,17 @@ class RsyncTask(Task):
         self.project_path = project_path
         self.files = files
 
+        # The name of the upload of the tarball of the created and modified
+        # files sent in bulk, if any.
+        self.bulk = bulk
+
+        # True if the sync writes in the .git directory.
+        self.git_touched = False
+
+        # The full paths of the files written by the sync, made durable at
+        # its end in batch durability mode.
+        self.touched = set()
+
         self.modif_files = []
         self.create_files = []
         self.mov_files = []
@@ -177,14 +278,59 @@ class RsyncTask(Task):
         # finished.
         self.rsync_finished = threading.Event()
 
+        # Declare a thread Event to wait until the list of files is known.
+        # If the files are sent in a binary manifest, they're maybe not yet
+        # received.
+        self.files_received = threading.Event()
+        if files is not None:
+            self.files_received.set()
+
+    def set_files(self, files):
+        """ Sets the list of files received in a binary manifest.
+        """
+
+        self.files = files
+        self.files_received.set()
+
     def run(self):
 
+        try:
+            self._sync()
+        finally:
+            # The health of the repository is checked again if its .git
+            # directory has changed.
+            if self.git_touched:
+                health.invalidate(self.project_path)
+
+    def _sync(self):
+        """ Applies the file events of the rsync.
+        """
+
         self.logger.debug('RsyncTask %s started' % self.sid)
 
-        # Lock the repository with a .baboon.lock file.
-        lock_file = os.path.join(self.project_path, '.baboon.lock')
-        create_missing_dirs(lock_file)
-        open(lock_file, 'w').close()
+        # Wait until the binary manifest is received (if any).
+        self.files_received.wait(240)
+        if self.files is None:
+            self.logger.error('Timeout on the manifest of the rsync %s.' %
+                              self.rid)
+            eventbus.fire('rsync-finished-failure', rid=self.rid)
+            return
+
+        # Lock the repository with a .baboon.lock file. A background rsync
+        # runs beside the interactive ones and never holds off the merge
+        # detection: it does not lock the repository.
+        lock_file = self._lock()
+
+        self.git_touched = bool([x for x in self.files if
+                                 is_git_path(x.src_path) or
+                                 (x.dest_path and is_git_path(x.dest_path))])
+
+        # The files sent in bulk are extracted first. Their paths are never
+        # involved in the other events.
+        if self.bulk and not self._extract_bulk():
+            self._unlock(lock_file)
+            eventbus.fire('rsync-finished-failure', rid=self.rid)
+            return
 
         for f in self.files:
             # Verify if the file can be written in the self.project_path.
@@ -192,13 +338,31 @@ class RsyncTask(Task):
             if not path_valid:
                 self.logger.error("The file path cannot be written in %s." %
                                   self.project)
+                self._unlock(lock_file)
                 eventbus.fire('rsync-finished-failure', rid=self.rid)
                 return
 
-            if f.event_type == FileEvent.CREATE:
+            if f.event_type == FileEvent.CREATE and f.content is not None:
+                self.logger.debug('[%s] - Need to create %s with its '
+                                  'content.' % (self.project_path, f.src_path))
+                self._write_file(f.src_path, zlib.decompress(f.content))
+            elif f.event_type == FileEvent.CREATE and f.streamed:
+                self.logger.debug('[%s] - Need to create %s with its '
+                                  'streamed content.' % (self.project_path,
+                                                         f.src_path))
+                self._create_streamed_file(f.src_path)
+            elif f.event_type == FileEvent.CREATE:
                 self.logger.debug('[%s] - Need to create %s.' %
                                  (self.project_path, f.src_path))
                 self._create_file(f.src_path)
+            elif f.event_type == FileEvent.MODIF and f.content is not None:
+                self.logger.debug('[%s] - Need to write %s.' %
+                                 (self.project_path, f.src_path))
+                self._write_file(f.src_path, zlib.decompress(f.content))
+            elif f.event_type == FileEvent.MODIF and f.oid is not None and \
+                    self._checkout_blob(f.src_path, f.oid):
+                self.logger.debug('[%s] - %s restored from the blob %s.' %
+                                 (self.project_path, f.src_path, f.oid))
             elif f.event_type == FileEvent.MODIF:
                 self.logger.debug('[%s] - Need to sync %s.' %
                                  (self.project_path, f.src_path))
@@ -213,14 +377,45 @@ class RsyncTask(Task):
                                  (self.project_path, f.src_path, f.dest_path))
                 self._move_file(f.src_path, f.dest_path)
 
+        # Make the written files durable (batch mode).
+        durability.flush(self.touched)
+
         # Remove the .baboon.lock file.
-        os.remove(lock_file)
+        self._unlock(lock_file)
 
         # Fire the rsync-finished-success event.
         eventbus.fire('rsync-finished-success', rid=self.rid)
 
         self.logger.debug('Rsync task %s finished', self.sid)
 
+    def _lock(self):
+        """ Creates the .baboon.lock file of the repository and returns its
+        path. A background rsync does not lock the repository: returns None.
+        """
+
+        if self.background:
+            return None
+
+        lock_file = os.path.join(self.project_path, '.baboon.lock')
+        create_missing_dirs(lock_file)
+        open(lock_file, 'w').close()
+
+        return lock_file
+
+    def _unlock(self, lock_file):
+        """ Removes the lock_file, if any. Another rsync of the user has
+        maybe already removed it.
+        """
+
+        if not lock_file:
+            return
+
+        try:
+            os.remove(lock_file)
+        except OSError:
+            # Already removed.
+            pass
+
     def _verify_paths(self, file_event):
         """ Verifies if the file_event paths can be written in the
         project_path.
@@ -250,6 +445,119 @@ class RsyncTask(Task):
         create_missing_dirs(fullpath)
         open(fullpath, 'w').close()
 
+    def _create_streamed_file(self, f):
+        """ Creates the file f with the content streamed over the
+        bytestream.
+        """
+
+        upload = transport.get_upload(self.jid.bare, self.project, f)
+        upload.finished.wait(self.timeout)
+
+        if not upload.finished.is_set():
+            self.logger.error('Timeout on the upload of %s.' % f)
+            transport.discard_upload(self.jid.bare, self.project, f)
+            self._create_file(f)
+            return
+
+        transport.pop_upload(self.jid.bare, self.project, f)
+
+        fullpath = os.path.join(self.project_path, f)
+        create_missing_dirs(fullpath)
+        os.chmod(upload.path, 0644)
+        os.rename(upload.path, fullpath)
+        durability.after_rename(fullpath, self.touched)
+
+    def _extract_bulk(self):
+        """ Extracts the tarball of the files sent in bulk in the
+        project_path. Only the regular files with a valid relative path are
+        extracted. Returns False if the tarball cannot be received or read.
+        """
+
+        upload = transport.get_upload(self.jid.bare, self.project, self.bulk)
+        upload.finished.wait(self.timeout)
+
+        if not upload.finished.is_set():
+            self.logger.error('Timeout on the tarball of the rsync %s.' %
+                              self.rid)
+            transport.discard_upload(self.jid.bare, self.project, self.bulk)
+            return False
+
+        transport.pop_upload(self.jid.bare, self.project, self.bulk)
+
+        try:
+            # TarFile is not a context manager in python 2.6.
+            tar = tarfile.open(upload.path, 'r:gz')
+            try:
+                for member in tar:
+                    # The tarball comes from the client. Never extract the
+                    # links, the devices or a path outside of the project.
+                    parts = member.name.split('/')
+                    if not member.isfile() or os.path.isabs(member.name) or \
+                            '..' in parts or not \
+                            self._verify_path(member.name):
+                        self.logger.warning('[%s] - %s skipped from the '
+                                            'tarball.' % (self.project_path,
+                                                          member.name))
+                        continue
+
+                    self._write_file(member.name,
+                                     tar.extractfile(member).read())
+                    if is_git_path(member.name):
+                        self.git_touched = True
+            finally:
+                tar.close()
+
+            self.logger.debug('[%s] - Tarball of the rsync %s extracted.' %
+                              (self.project_path, self.rid))
+            return True
+        except (tarfile.TarError, EnvironmentError) as err:
+            self.logger.error('Cannot extract the tarball of the rsync %s: '
+                              '%s' % (self.rid, err))
+            return False
+        finally:
+            os.remove(upload.path)
+
+    def _write_file(self, f, content):
+        """ Replaces the content of the file f with the content received
+        inline.
+        """
+
+        fullpath = os.path.join(self.project_path, f)
+        create_missing_dirs(fullpath)
+
+        # Write a temporary file in the same directory and rename it over the
+        # file in order to never have a partially written file.
+        fd = tempfile.NamedTemporaryFile(dir=os.path.dirname(fullpath),
+                                         delete=False)
+        try:
+            fd.write(content)
+            durability.before_rename(fd)
+        finally:
+            fd.close()
+
+        # Keep the permissions of the replaced file.
+        if os.path.exists(fullpath):
+            shutil.copymode(fullpath, fd.name)
+        else:
+            os.chmod(fd.name, 0644)
+
+        os.rename(fd.name, fullpath)
+        durability.after_rename(fullpath, self.touched)
+
+    def _checkout_blob(self, f, oid):
+        """ Writes the f file from the oid blob of the server-side
+        repository. Returns False if the blob is unknown.
+        """
+
+        content = gitrefs.get_blob(self.project_path, oid)
+        if content is None:
+            return False
+
+        # Nothing has been transferred for this file.
+        stats.delta(self.project, f, len(content), [])
+        self._write_file(f, content)
+        return True
+
     def _move_file(self, src, dest):
         """ Move the src path to the dest path.
         """
@@ -257,10 +565,27 @@ class RsyncTask(Task):
         src_fullpath = os.path.join(self.project_path, src)
         dest_fullpath = os.path.join(self.project_path, dest)
 
-        shutil.move(src_fullpath, dest_fullpath)
+        # The src path is maybe already moved with its parent directory.
+        if not os.path.lexists(src_fullpath):
+            self.logger.warning("Cannot move %s, it does not exist." %
+                                src_fullpath)
+            return
+
+        # The dest path is replaced, like a rename client-side.
+        create_missing_dirs(dest_fullpath)
+        if os.path.isdir(dest_fullpath) and \
+                not os.path.islink(dest_fullpath):
+            shutil.rmtree(dest_fullpath)
+
+        os.rename(src_fullpath, dest_fullpath)
+        durability.after_rename(dest_fullpath, self.touched)
         self.logger.debug("Moving %s to %s done." % (src_fullpath,
                                                      dest_fullpath))
 
+        # Delete the parent directories of src left empty.
+        self._clean_directory(self.project_path,
+                              os.path.dirname(src_fullpath))
+
     def _delete_file(self, f):
         """ Delete the file f from the project path.
         """
@@ -282,8 +607,8 @@ class RsyncTask(Task):
                     self._clean_directory(self.project_path,
                                           os.path.dirname(fullpath))
 
-                elif os.path.isdir(f):
-                    shutil.rmtree(f)
+                elif os.path.isdir(fullpath):
+                    shutil.rmtree(fullpath)
                     self.logger.info('Directory recursively deleted: %s' % f)
             except OSError:
                 # There's no problem if the file/dir does not
@@ -309,8 +634,12 @@ class RsyncTask(Task):
         if os.path.isfile(fullpath):
             # Computes the block checksums and add the result to the
             # all_hashes list.
+            start = time.time()
             with open(fullpath, 'rb') as unpatched:
-                return (f, pyrsync.blockchecksums(unpatched, blocksize=8192))
+                hashes = pyrsync.blockchecksums(unpatched, blocksize=8192)
+
+            stats.observe(self.project, 'hash', time.time() - start)
+            return (f, hashes)
 
     def _send_hash(self, h):
         """ Sends over the transport streamer the hash h.
@@ -324,13 +653,12 @@ class RsyncTask(Task):
             'hashes': [h],
         }
 
-        # Gets the proxy_socket associated to the SID and send the payload.
-        proxy_sock = transport.streamer.get_socket(self.sid)
-        proxy_sock.sendall(proxy_socket.pack(payload))
+        # Send the payload over the bytestream associated to the SID.
+        stats.request_started(self.rid)
+        transport.send_frame(self.sid, payload)
 
         # Wait until the rsync is finished.
-        # TODO: It takes sometimes more than 240 sec (i.e. git pack files)
-        self.rsync_finished.wait(240)
+        self.rsync_finished.wait(self.timeout)
 
         if not self.rsync_finished.is_set():
             self.logger.error('Timeout on rsync detected !')
@@ -410,6 +738,8 @@ class MergeTask(Task):
     """ A task to test if there's a conflict or not.
     """
 
+    exclusive = True
+
     def __init__(self, project_name, username):
         """ Initialize the MergeTask.
 
@@ -1,11 +1,12 @@
 import os
 import shutil
-import subprocess
 import struct
 import tempfile
 import pickle
+import time
+import zlib
 
-from threading import Event
+from threading import Event, Lock
 from os.path import join
 
 from sleekxmpp import ClientXMPP
@@ -14,14 +15,89 @@ from sleekxmpp.xmlstream.handler.callback import Callback
 from sleekxmpp.xmlstream.matcher import StanzaPath
 
 from baboon.baboond.dispatcher import dispatcher
+from baboon.baboond.subscriptions import subscriptions
+from baboon.baboond.health import health
+from baboon.baboond.durability import durability, NONE
 from baboon.baboond.config import config
 from baboon.common import proxy_socket
+from baboon.common import manifest
+from baboon.common import gitrefs
+from baboon.common.dataplane import dataplane
+from baboon.common.workerpool import WorkerPool
 from baboon.common.stanza.rsync import MergeStatus
 from baboon.common.eventbus import eventbus
 from baboon.common.logger import logger
+from baboon.common.errors.baboon_exception import BaboonException
+from baboon.common.stats import stats
 from baboon.common import pyrsync
 
 
+class Upload(object):
+    """ The content of a created file streamed over the bytestream. It's
+    written chunk by chunk in a temporary file of the project directory until
+    the RsyncTask moves it in place.
+    """
+
+    def __init__(self, project_path):
+
+        self.project_path = project_path
+        self.path = None
+        self.fd = None
+
+        # Set when the last chunk is received, at finished_at.
+        self.finished = Event()
+        self.finished_at = None
+
+        # True if the content is no longer wanted (e.g. the rsync stanza has
+        # been rejected). The temporary file is removed once finished.
+        self.discarded = False
+
+    def write(self, data):
+        """ Appends the data chunk to the temporary file.
+        """
+
+        if self.fd is None:
+            fd, self.path = tempfile.mkstemp(prefix='.baboon-upload-',
+                                             dir=self.project_path)
+            self.fd = os.fdopen(fd, 'wb')
+
+        self.fd.write(data)
+
+    def finish(self):
+        """ Closes the temporary file once the last chunk is received.
+        """
+
+        # An empty file.
+        self.write('')
+        durability.before_rename(self.fd)
+        self.fd.close()
+        self.finished_at = time.time()
+        self.finished.set()
+
+        if self.discarded:
+            self._remove()
+
+    def discard(self):
+        """ Drops the content. The temporary file is removed now if the
+        upload is finished, once finished otherwise.
+        """
+
+        self.discarded = True
+        if self.finished.is_set():
+            self._remove()
+
+    def _remove(self):
+        """ Removes the temporary file, if any.
+        """
+
+        try:
+            if self.path:
+                os.remove(self.path)
+        except OSError:
+            # Already removed.
+            pass
+
+
 @logger
 class Transport(ClientXMPP):
     """ The transport has the responsability to communicate with the
@@ -38,13 +114,54 @@ class Transport(ClientXMPP):
         self.pubsub_addr = config['server']['pubsub']
         self.working_dir = config['server']['working_dir']
 
+        # If the data plane is enabled, all the bytestreams are handled by
+        # a single event loop instead of a thread by socket.
+        self.use_dataplane = bool(int(config['server'].get('dataplane', 0)))
+        dataplane.workers = int(config['server'].get('dataplane_workers', 4))
+
+        # The rsync, git-sync, merge and git-init stanzas are handled by
+        # stanza_workers threads instead of the sleekxmpp event thread. At most
+        # stanza_queue of them are pending.
+        self.stanza_pool = WorkerPool(
+            int(config['server'].get('stanza_workers', 4)),
+            name='StanzaWorker',
+            maxsize=int(config['server'].get('stanza_queue', 64)))
+        self.stanza_pool.start()
+
+        # The durability mode of the written files (none, batch or file).
+        durability.set_mode(config['server'].get('durability', NONE))
+
+        # The deltas are applied by patch_workers threads instead of the
+        # threads receiving the frames.
+        self.patch_pool = WorkerPool(
+            int(config['server'].get('patch_workers', 4)),
+            name='PatchWorker')
+        self.patch_pool.start()
+
+        # The subscribers of the nodes are kept in memory subscription_ttl
+        # secs.
+        subscriptions.ttl = int(config['server'].get('subscription_ttl', 60))
+
         # Some shortcuts
         self.pubsub = self.plugin['xep_0060']
         self.streamer = self.plugin['xep_0065']
 
         self.disconnected = Event()
-        self.pending_rsyncs = {}   # {SID => RsyncTask}
+        self.pending_rsyncs = {}   # {RID => RsyncTask or GitSyncTask}
         self.pending_git_init_tasks = {}  # {BID => GitInitTask}
+        self.pending_manifests = {}  # {RID => [FileEvent]}
+        self.pending_bundles = {}  # {RID => bundle data}
+        self.uploads = {}  # {(JID, node, path) => Upload}
+
+        # The finished uploads never used by a RsyncTask (e.g. the stanza
+        # never arrived) are removed after upload_ttl secs.
+        self.upload_ttl = int(config['server'].get('background_timeout',
+                                                   3600))
+
+        # Protects pending_rsyncs, pending_manifests and pending_bundles. A
+        # binary manifest (or a bundle) can be received before or after its
+        # stanza.
+        self.rsyncs_lock = Lock()
 
         # Bind all handlers to corresponding events.
         self._bind()
@@ -59,6 +176,10 @@ class Transport(ClientXMPP):
         """ Disconnect from the XMPP server.
         """
 
+        if self.use_dataplane:
+            dataplane.close()
+        self.stanza_pool.close()
+        self.patch_pool.close()
         self.streamer.close()
         self.disconnect(wait=True)
         self.disconnected.set()
@@ -89,11 +210,22 @@ class Transport(ClientXMPP):
         self.add_event_handler('session_start', self._on_session_start)
         self.add_event_handler('failed_auth', self._on_failed_auth)
         self.add_event_handler('socks_connected', self._on_socks_connected)
+        self.add_event_handler('pubsub_subscription',
+                               self._on_pubsub_subscription)
+        self.add_event_handler('pubsub_delete', self._on_pubsub_delete)
 
         self.register_handler(Callback('First Git Init Handler',
                                        StanzaPath('iq@type=set/git-init'),
                                        self._on_git_init_stanza))
 
+        self.register_handler(Callback('GitRefs Handler',
+                                       StanzaPath('iq@type=get/git-sync'),
+                                       self._on_git_refs_stanza))
+
+        self.register_handler(Callback('GitSync Handler',
+                                       StanzaPath('iq@type=set/git-sync'),
+                                       self._on_git_sync_stanza))
+
         self.register_handler(Callback('RsyncStart Handler',
                                        StanzaPath('iq@type=set/rsync'),
                                        self._on_rsync_stanza))
@@ -124,18 +256,53 @@ class Transport(ClientXMPP):
         eventbus.fire('failed-auth')
         self.close()
 
+    def _on_pubsub_subscription(self, msg):
+        """ Called when a subscription of a node changes. The cached
+        subscribers of the node are no longer valid.
+        """
+
+        subscriptions.invalidate(msg['pubsub_event']['subscription']['node'])
+
+    def _on_pubsub_delete(self, msg):
+        """ Called when a node is deleted.
+        """
+
+        subscriptions.invalidate(msg['pubsub_event']['delete']['node'])
+
     def _on_socks_connected(self, sid):
         """ Called when the Socks5 bytestream plugin is connected.
         """
 
         proxy_sock = self.streamer.get_socket(sid)
-        proxy_listener = proxy_socket.listen(sid, proxy_sock,
-                                             self._on_socks5_data)
+        if self.use_dataplane:
+            dataplane.register(sid, proxy_sock, self._on_socks5_data)
+        else:
+            proxy_socket.listen(sid, proxy_sock, self._on_socks5_data)
         self.logger.debug("Socks5 connected.")
 
+    def send_frame(self, sid, payload):
+        """ Packs and sends the payload dict over the bytestream associated
+        to the sid.
+        """
+
+        packed = proxy_socket.pack(payload)
+        stats.frame_out(sid, payload.get('node'), len(packed))
+
+        if self.use_dataplane:
+            dataplane.send(sid, packed)
+        else:
+            self.streamer.get_socket(sid).sendall(packed)
+
     def _on_git_init_stanza(self, iq):
-        """ Called when a GitInit stanza is received. This handler creates a
-        new GitInitTask if permissions are good.
+        """ Called when a GitInit stanza is received. The stanza is handled by
+        a stanza worker.
+        """
+
+        self._offload(iq, iq['git-init']['node'], self._handle_git_init_stanza)
+
+    def _handle_git_init_stanza(self, iq):
+        """ Handles a GitInit stanza. Creates a new GitInitTask if permissions
+        are good.
         """
 
         self.logger.info("Received a git init stanza.")
@@ -160,11 +327,20 @@ class Transport(ClientXMPP):
         self.pending_git_init_tasks[git_init_task.bid] = iq
 
         # Add the GitInitTask to the list of tasks to execute.
-        dispatcher.put(node, git_init_task)
+        dispatcher.put(node, git_init_task, user=sfrom)
 
     def _on_rsync_stanza(self, iq):
-        """ Called when a Rsync stanza is received. This handler creates a
-        new RsyncTask if permissions are good.
+        """ Called when a Rsync stanza is received. The stanza is handled by
+        a stanza worker.
+        """
+
+        if not self._offload(iq, iq['rsync']['node'],
+                             self._handle_rsync_stanza):
+            self._discard_uploads(iq)
+
+    def _handle_rsync_stanza(self, iq):
+        """ Handles a Rsync stanza. Creates a new RsyncTask if permissions are
+        good.
         """
 
         self.logger.info('Received a rsync stanza.')
@@ -180,27 +356,128 @@ class Transport(ClientXMPP):
         # Verify if the user is a subscriber/owner of the node.
         is_subscribed = self._verify_subscription(iq, sfrom.bare, node)
         if not is_subscribed:
+            self._discard_uploads(iq)
             eventbus.fire('rsync-finished-failure', rid=rid)
             return
 
         # The future reply iq.
         reply = iq.reply()
 
-        # Create the new RsyncTask.
         from task import RsyncTask
-        rsync_task = RsyncTask(sid, rid, sfrom, node, project_path, files)
-        dispatcher.put(node, rsync_task)
+        with self.rsyncs_lock:
+            # If the files are sent in a binary manifest, it's maybe already
+            # received. Otherwise, the RsyncTask will wait for it.
+            if iq['rsync']['manifest'] == 'binary':
+                files = self.pending_manifests.pop(rid, None)
 
-        # Register the current rsync_task in the pending_rsyncs dict.
-        self.pending_rsyncs[rid] = rsync_task
+            # Create the new RsyncTask.
+            rsync_task = RsyncTask(sid, rid, sfrom, node, project_path, files,
+                                   lane=iq['rsync']['lane'],
+                                   bulk=iq['rsync']['bulk'] or None)
+
+            # Register the current rsync_task in the pending_rsyncs dict.
+            self.pending_rsyncs[rid] = rsync_task
+
+        dispatcher.put(node, rsync_task, user=sfrom.bare,
+                       background=rsync_task.background)
 
         # Reply to the IQ
         reply['rsync']
         reply.send()
 
+    def _on_git_refs_stanza(self, iq):
+        """ Called when a GitSync get stanza is received. The stanza is
+        handled by a stanza worker.
+        """
+
+        self._offload(iq, iq['git-sync']['node'], self._handle_git_refs_stanza)
+
+    def _handle_git_refs_stanza(self, iq):
+        """ Handles a GitSync get stanza. Replies with the refs of the
+        server-side repository of the user.
+        """
+
+        # Get the useful data.
+        node = iq['git-sync']['node']
+        sfrom = iq['from'].bare
+        project_path = join(self.working_dir, node, sfrom)
+
+        # Verify if the user is a subscriber/owner of the node.
+        is_subscribed = self._verify_subscription(iq, sfrom, node)
+        if not is_subscribed:
+            return
+
+        try:
+            refs = gitrefs.get_refs(project_path)
+        except BaboonException as err:
+            self.logger.error(err)
+            err_msg = ("The repository %s seems to be corrupted. Please, "
+                       " (re)run the init command." % node)
+            self._send_forbidden_error(iq.reply(), err_msg)
+            return
+
+        reply = iq.reply()
+        reply['git-sync']['node'] = node
+        reply['git-sync']['refs'] = refs
+        reply.send()
+
+    def _on_git_sync_stanza(self, iq):
+        """ Called when a GitSync set stanza is received. The stanza is
+        handled by a stanza worker.
+        """
+
+        self._offload(iq, iq['git-sync']['node'], self._handle_git_sync_stanza)
+
+    def _handle_git_sync_stanza(self, iq):
+        """ Handles a GitSync set stanza. Creates a new GitSyncTask if
+        permissions are good.
+        """
+
+        self.logger.info('Received a git sync stanza.')
+
+        # Get the useful data.
+        node = iq['git-sync']['node']
+        rid = iq['git-sync']['rid']
+        refs = iq['git-sync']['refs']
+        has_bundle = iq['git-sync']['bundle'] == 'yes'
+        sfrom = iq['from']
+        project_path = join(self.working_dir, node, sfrom.bare)
+
+        # Verify if the user is a subscriber/owner of the node.
+        is_subscribed = self._verify_subscription(iq, sfrom.bare, node)
+        if not is_subscribed:
+            with self.rsyncs_lock:
+                self.pending_bundles.pop(rid, None)
+            return
+
+        from task import GitSyncTask
+        with self.rsyncs_lock:
+            git_sync_task = GitSyncTask(rid, sfrom, node, project_path, refs,
+                                        bundle=has_bundle)
+
+            # The bundle is maybe already received. Otherwise, the
+            # GitSyncTask will wait for it.
+            bundle = self.pending_bundles.pop(rid, None)
+            if bundle is not None:
+                git_sync_task.set_bundle(bundle)
+
+            self.pending_rsyncs[rid] = git_sync_task
+
+        dispatcher.put(node, git_sync_task, user=sfrom.bare)
+
+        # Reply to the IQ
+        iq.reply().send()
+
     def _on_merge_stanza(self, iq):
-        """ Called when a MergeVerification stanza is received. This handler
-        creates a new MergeTask if permissions are good.
+        """ Called when a MergeVerification stanza is received. The stanza is
+        handled by a stanza worker.
+        """
+
+        self._offload(iq, iq['merge']['node'], self._handle_merge_stanza)
+
+    def _handle_merge_stanza(self, iq):
+        """ Handles a MergeVerification stanza. Creates a new MergeTask if
+        permissions are good.
         """
 
         # Get the useful data.
@@ -229,6 +506,44 @@ class Transport(ClientXMPP):
         # Reply to the request.
         reply.send()
 
+    def _offload(self, iq, node, handler):
+        """ Hands the iq to the handler in a stanza worker. The stanzas of a
+        user on a node are handled in the receiving order. If too many
+        stanzas are pending, the iq is rejected with a wait error and False is
+        returned.
+        """
+
+        sfrom = iq['from'].bare
+        if self.stanza_pool.is_full():
+            self.logger.warning('Too many pending stanzas. The stanza of %s '
+                                'is rejected.' % sfrom)
+            self._send_busy_error(iq.reply(), "the server is busy, retry "
+                                  "later.")
+            return False
+
+        self.stanza_pool.submit_ordered((sfrom, node), self._run_handler,
+                                        handler, iq)
+        return True
+
+    def _run_handler(self, handler, iq):
+        """ Runs the handler of the iq in a stanza worker. If the handler
+        fails, an error is replied. The client never waits until its
+        timeout.
+        """
+
+        try:
+            handler(iq)
+        except Exception as err:
+            self.logger.exception(err)
+
+            reply = iq.reply()
+            reply.error()
+            reply['error']['code'] = '500'
+            reply['error']['type'] = 'cancel'
+            reply['error']['condition'] = 'internal-server-error'
+            reply['error']['text'] = str(err)
+            reply.send()
+
     def _on_socks5_data(self, sid, data, **kwargs):
         """ Called when receiving data over the socks5 socket (xep
         0065).
@@ -236,6 +551,34 @@ class Transport(ClientXMPP):
 
         self.logger.debug("Received data over socks5 socket.")
 
+        if 'manifest' in data:
+            self._on_manifest(data)
+            return
+
+        if 'bundle' in data:
+            self._on_bundle(data)
+            return
+
+        if 'upload' in data:
+            self._on_upload(data)
+            return
+
+        # Patch the files in a patch worker. The socket is free to receive
+        # the next frames. The deltas of a user on a node are applied in the
+        # receiving order. The deltas of the background syncs never delay the
+        # other ones.
+        key = (JID(data['from']).bare, data['node'])
+        cur_rsync_task = self.pending_rsyncs.get(data['rid'])
+        if cur_rsync_task and getattr(cur_rsync_task, 'background', False):
+            key += ('background',)
+
+        self.patch_pool.submit_ordered(key, self._on_deltas, data)
+
+    def _on_deltas(self, data):
+        """ Called in a patch worker to apply the deltas received over the
+        socks5 socket. The RsyncTask is notified once the files are patched.
+        """
+
         # Get the useful data.
         node = data['node']
         rid = data['rid']
@@ -243,16 +586,167 @@ class Transport(ClientXMPP):
         deltas = data['delta']
         project_path = join(self.working_dir, node, sfrom.bare)
 
-        # Patch files with corresponding deltas.
-        for relpath, delta in deltas:
-            self._patch_file(join(project_path, relpath), delta)
-
+        # The patched files are made durable at the end of the RsyncTask in
+        # batch mode.
         cur_rsync_task = self.pending_rsyncs.get(rid)
-        if cur_rsync_task:
-            cur_rsync_task.rsync_finished.set()
-        else:
-            self.logger.error('Rsync task %s not found.' % rid)
-            # TODO: Handle this error.
+        touched = cur_rsync_task.touched if cur_rsync_task else None
+
+        try:
+            # Patch files with corresponding deltas.
+            for relpath, delta in deltas:
+                start = time.time()
+                self._patch_file(join(project_path, relpath), delta,
+                                 touched=touched)
+                stats.observe(node, 'patch', time.time() - start)
+        except EnvironmentError as err:
+            self.logger.error('Cannot patch the files of the rsync %s: %s' %
+                              (rid, err))
+        finally:
+            # Never let the RsyncTask wait until the timeout.
+            if cur_rsync_task:
+                cur_rsync_task.rsync_finished.set()
+            else:
+                self.logger.error('Rsync task %s not found.' % rid)
+                # TODO: Handle this error.
+
+    def _on_manifest(self, data):
+        """ Called when a binary manifest is received over the socks5
+        socket. Gives the list of files to the associated RsyncTask or keeps
+        it until the rsync stanza is received.
+        """
+
+        rid = data['rid']
+        try:
+            files = manifest.unpack(data['node'], data['manifest'])
+        except BaboonException as err:
+            self.logger.error(err)
+            files = []
+
+        with self.rsyncs_lock:
+            cur_rsync_task = self.pending_rsyncs.get(rid)
+            if not cur_rsync_task:
+                self.pending_manifests[rid] = files
+                return
+
+        cur_rsync_task.set_files(files)
+
+    def _on_bundle(self, data):
+        """ Called when a git bundle is received over the socks5 socket.
+        Gives it to the associated GitSyncTask or keeps it until the git sync
+        stanza is received.
+        """
+
+        rid = data['rid']
+        with self.rsyncs_lock:
+            git_sync_task = self.pending_rsyncs.get(rid)
+            if not git_sync_task:
+                self.pending_bundles[rid] = data['bundle']
+                return
+
+        git_sync_task.set_bundle(data['bundle'])
+
+    def _on_upload(self, data):
+        """ Called when a chunk of a streamed created file is received over
+        the socks5 socket.
+        """
+
+        jid = JID(data['from']).bare
+        upload = self.get_upload(jid, data['node'], data['upload'],
+                                 writer=True)
+
+        if data['data']:
+            start = time.time()
+            upload.write(zlib.decompress(data['data']))
+            stats.observe(data['node'], 'upload', time.time() - start)
+
+        if data['eof']:
+            upload.finish()
+
+            # Nobody waits for a discarded upload.
+            if upload.discarded:
+                with self.rsyncs_lock:
+                    if self.uploads.get((jid, data['node'],
+                                         data['upload'])) is upload:
+                        del self.uploads[(jid, data['node'], data['upload'])]
+
+    def get_upload(self, jid, node, path, writer=False):
+        """ Returns the Upload of the path created by the bare jid in the
+        node. If the upload is not yet started, it will be created. A writer
+        never gets a finished upload: it's a new upload of the path.
+        """
+
+        with self.rsyncs_lock:
+            self._expire_uploads()
+
+            upload = self.uploads.get((jid, node, path))
+            if upload and writer and upload.finished.is_set():
+                upload.discard()
+                upload = None
+
+            if not upload:
+                project_path = join(self.working_dir, node, jid)
+                upload = Upload(project_path)
+                self.uploads[(jid, node, path)] = upload
+
+            return upload
+
+    def discard_upload(self, jid, node, path):
+        """ Drops the Upload of the path created by the bare jid in the
+        node. An upload not yet finished is forgotten once finished.
+        """
+
+        with self.rsyncs_lock:
+            upload = self.uploads.get((jid, node, path))
+            if not upload:
+                return
+
+            if upload.finished.is_set():
+                del self.uploads[(jid, node, path)]
+
+        upload.discard()
+
+    def _discard_uploads(self, iq):
+        """ Drops the uploads (streamed created files and bulk tarball) of
+        the rejected rsync iq. The lock must not be held.
+        """
+
+        jid = iq['from'].bare
+        node = iq['rsync']['node']
+
+        with self.rsyncs_lock:
+            files = self.pending_manifests.pop(iq['rsync']['rid'], None)
+
+        if iq['rsync']['manifest'] != 'binary':
+            files = iq['rsync']['files']
+
+        names = [x.src_path for x in files or [] if x.streamed]
+        if iq['rsync']['bulk']:
+            names.append(iq['rsync']['bulk'])
+
+        for name in names:
+            self.discard_upload(jid, node, name)
+
+    def _expire_uploads(self):
+        """ Drops the uploads finished for more than upload_ttl secs. The
+        lock must be held.
+        """
+
+        now = time.time()
+        for key, upload in self.uploads.items():
+            if upload.finished.is_set() and \
+                    now - upload.finished_at > self.upload_ttl:
+                self.logger.warning('The upload of %s has never been used.' %
+                                    key[2])
+                del self.uploads[key]
+                upload.discard()
+
+    def pop_upload(self, jid, node, path):
+        """ Forgets the Upload of the path created by the bare jid in the
+        node.
+        """
+
+        with self.rsyncs_lock:
+            self.uploads.pop((jid, node, path), None)
 
     def _on_git_init_success(self, bid):
         """ Called when a git init task has been terminated successfuly.
@@ -296,11 +790,16 @@ class Transport(ClientXMPP):
     def _on_rsync_success(self, rid, *args, **kwargs):
         """ Called when a rsync task has been terminated successfuly.
         """
-        cur_rsync_task = self.pending_rsyncs.get(rid)
+        stats.request_finished(rid)
+
+        # Forget the task (and the file contents it holds).
+        with self.rsyncs_lock:
+            cur_rsync_task = self.pending_rsyncs.pop(rid, None)
         if cur_rsync_task:
             self.logger.debug("RsyncTask %s finished." % rid)
             iq = self.Iq(sto=cur_rsync_task.jid, stype='set')
             iq['rsyncfinished']['node'] = cur_rsync_task.project
+            iq['rsyncfinished']['rid'] = rid
             iq.send(block=False)
         else:
             self.logger.error("Could not find a rsync task with RID: %s" % rid)
@@ -313,26 +812,39 @@ class Transport(ClientXMPP):
         if rid is None:
             return
 
-        cur_rsync_task = self.pending_rsyncs.get(rid)
+        stats.request_finished(rid)
+
+        # Forget the task (and the file contents it holds).
+        with self.rsyncs_lock:
+            cur_rsync_task = self.pending_rsyncs.pop(rid, None)
         if cur_rsync_task:
             self.logger.debug("RsyncTask %s finished with an error." % rid)
 
             # TODO: Add a status (success/error) to the rsyncfinished iq.
             iq = self.Iq(sto=cur_rsync_task.jid, stype='set')
             iq['rsyncfinished']['node'] = cur_rsync_task.project
+            iq['rsyncfinished']['rid'] = rid
             iq.send(block=False)
 
     def _verify_subscription(self, iq, jid, node):
-        """ Verify if the bare jid is a subscriber/owner on the node.
+        """ Verify if the bare jid is a subscriber/owner on the node. The
+        answer comes from the subscriptions cache if possible.
         """
 
+        jids = subscriptions.get(node)
+        if jids is not None and jid in jids:
+            return True
+
+        # Unknown subscribers or maybe a new subscriber not yet notified. Ask
+        # the pubsub service.
         try:
             ret = self.pubsub.get_node_subscriptions(self.pubsub_addr, node)
-            subscriptions = ret['pubsub_owner']['subscriptions']
+            jids = [x['jid'].bare for x in
+                    ret['pubsub_owner']['subscriptions']]
+            subscriptions.set(node, jids)
 
-            for subscription in subscriptions:
-                if jid == subscription['jid']:
-                    return True
+            if jid in jids:
+                return True
         except Exception as e:
             pass
 
@@ -342,16 +854,11 @@ class Transport(ClientXMPP):
         return False
 
     def _verify_git_repository(self, iq, node, path):
+        """ Verify if the repository at path is healthy. The health is
+        cached until a sync touches its .git directory.
         """
-        """
-
-        proc = subprocess.Popen('git status', stdin=subprocess.PIPE,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.STDOUT, shell=True,
-                                cwd=path)
-        output, errorss = proc.communicate()
 
-        if not proc.returncode:
+        if health.is_healthy(path):
             return True
         else:
             err_msg = ("The repository %s seems to be corrupted. Please, "
@@ -360,26 +867,35 @@ class Transport(ClientXMPP):
 
             return False
 
-    def _patch_file(self, fullpath, delta):
-        """ Patch the fullpath file with the delta.
+    def _patch_file(self, fullpath, delta, touched=None):
+        """ Patch the fullpath file with the delta. In batch durability
+        mode, the fullpath is added to the touched set.
         """
 
-        # Open the unpatched file with the cursor at the beginning.
-        unpatched = open(fullpath, 'rb')
-        unpatched.seek(0)
-
-        # Save the new file in a temporary file. Avoid to delete the file
-        # when it's closed.
-        save_fd = tempfile.NamedTemporaryFile(delete=False)
+        # Save the new file in a temporary file of the same directory. Avoid
+        # to delete the file when it's closed.
+        save_fd = tempfile.NamedTemporaryFile(dir=os.path.dirname(fullpath),
+                                              prefix='.baboon-patch-',
+                                              delete=False)
 
-        # Patch the file with the delta.
-        pyrsync.patchstream(unpatched, save_fd, delta)
+        try:
+            # Patch the file with the delta.
+            with open(fullpath, 'rb') as unpatched:
+                pyrsync.patchstream(unpatched, save_fd, delta)
+        except:
+            save_fd.close()
+            os.remove(save_fd.name)
+            raise
 
         # Close the file (data are flushed).
+        durability.before_rename(save_fd)
         save_fd.close()
 
-        # Rename the temporary file to the good file path.
-        shutil.move(save_fd.name, fullpath)
+        # Keep the permissions of the patched file and atomically rename the
+        # temporary file to the good file path (no copy, same filesystem).
+        shutil.copymode(fullpath, save_fd.name)
+        os.rename(save_fd.name, fullpath)
+        durability.after_rename(fullpath, touched)
 
     def _send_forbidden_error(self, iq, err_msg):
         """ Send an error iq with the err_msg as text.
@@ -391,5 +907,15 @@ class Transport(ClientXMPP):
         iq['error']['text'] = err_msg
         iq.send()
 
+    def _send_busy_error(self, iq, err_msg):
+        """ Send a wait error iq with the err_msg as text.
+        """
+        iq.error()
+        iq['error']['code'] = '500'
+        iq['error']['type'] = 'wait'
+        iq['error']['condition'] = 'resource-constraint'
+        iq['error']['text'] = err_msg
+        iq.send()
+
 
 transport = Transport()
@@ -0,0 +1,300 @@
+import os
+import errno
+import select
+import socket
+import struct
+import time
+
+from collections import deque
+from threading import Thread, Lock, current_thread
+
+from baboon.common import proxy_socket
+from baboon.common.logger import logger
+from baboon.common.workerpool import WorkerPool
+
+# The size of the frame header (a big-endian int, see proxy_socket.pack).
+HEADER_SIZE = 4
+
+
+class FrameReader(object):
+    """ Incrementally rebuilds the frames (see proxy_socket.pack) from the
+    chunks of data read on a non-blocking socket.
+    """
+
+    def __init__(self):
+
+        self.buf = ''
+        self.size = None
+        self.first_byte = None
+
+    def feed(self, data):
+        """ Adds the data chunk to the buffer. Returns the list of
+        (frame, first_byte) tuples completed by this chunk.
+        """
+
+        if self.first_byte is None:
+            self.first_byte = time.time()
+
+        self.buf += data
+
+        frames = []
+        while True:
+            if self.size is None:
+                if len(self.buf) < HEADER_SIZE:
+                    break
+
+                self.size = struct.unpack('>i', self.buf[:HEADER_SIZE])[0]
+                self.buf = self.buf[HEADER_SIZE:]
+
+            if len(self.buf) < self.size:
+                break
+
+            frames.append((self.buf[:self.size], self.first_byte))
+            self.buf = self.buf[self.size:]
+            self.size = None
+            self.first_byte = time.time() if self.buf else None
+
+        return frames
+
+
+class FrameWriter(object):
+    """ Buffers the frames to send on a non-blocking socket and writes them
+    when the socket is writable.
+    """
+
+    def __init__(self, sock):
+
+        self.sock = sock
+        self.chunks = deque()
+        self._lock = Lock()
+
+    def push(self, data):
+        """ Adds the data to the outgoing buffer.
+        """
+
+        with self._lock:
+            self.chunks.append(data)
+
+    def pending(self):
+        """ Returns True if there's data waiting to be written.
+        """
+
+        return bool(self.chunks)
+
+    def flush(self):
+        """ Writes as much buffered data as the socket accepts without
+        blocking.
+        """
+
+        with self._lock:
+            while self.chunks:
+                chunk = self.chunks[0]
+                try:
+                    sent = self.sock.send(chunk)
+                except socket.error as err:
+                    if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        return
+                    raise
+
+                if sent < len(chunk):
+                    self.chunks[0] = chunk[sent:]
+                    return
+
+                self.chunks.popleft()
+
+
+class Channel(object):
+    """ A bytestream registered in the data plane.
+    """
+
+    def __init__(self, sid, sock, callback):
+
+        self.sid = sid
+        self.sock = sock
+        self.callback = callback
+        self.reader = FrameReader()
+        self.writer = FrameWriter(sock)
+
+
+@logger
+class DataPlane(object):
+    """ A single thread that multiplexes all the bytestream sockets. Frames
+    are read and written without blocking. Unpacking the frames and running
+    the callbacks (hashes, deltas, patches...) is offloaded to a pool of
+    workers, one frame after another for each bytestream.
+    """
+
+    def __init__(self, workers=4):
+        """ Initializes the data plane. The thread is started with the first
+        registered socket (and again after a close).
+        """
+
+        self.workers = workers
+        self.pool = None
+        self.thread = None
+        self.stop = False
+
+        # Keys -> SID, Values -> the associated Channel.
+        self.channels = {}
+        self._lock = Lock()
+
+        # A pipe to wake up the select when a socket is registered or when
+        # there's data to write.
+        self._wakeup_r, self._wakeup_w = os.pipe()
+
+    def register(self, sid, sock, callback):
+        """ Starts listening on the socket associated to the SID for data.
+        When a frame is received, call the callback in a worker.
+        """
+
+        sock.setblocking(0)
+        with self._lock:
+            self.channels[sid] = Channel(sid, sock, callback)
+
+            if self.thread is None or not self.thread.is_alive():
+                self.stop = False
+                self.pool = WorkerPool(self.workers, name='DataPlaneWorker')
+                self.pool.start()
+
+                self.thread = Thread(target=self.run, name='DataPlane')
+                self.thread.daemon = True
+                self.thread.start()
+
+        self._wakeup()
+
+    def unregister(self, sid):
+        """ Stops listening on the socket associated to the SID.
+        """
+
+        with self._lock:
+            self.channels.pop(sid, None)
+
+        self._wakeup()
+
+    def send(self, sid, data):
+        """ Sends the packed data over the socket associated to the SID
+        without blocking the caller.
+        """
+
+        channel = self.channels.get(sid)
+        if not channel:
+            raise socket.error(errno.EBADF, 'Unknown SID: %s' % sid)
+
+        channel.writer.push(data)
+        self._wakeup()
+
+    def close(self):
+        """ Sets the stop flag to True and stops the thread and the workers.
+        The next registered socket starts them again.
+        """
+
+        with self._lock:
+            thread, pool = self.thread, self.pool
+            self.stop = True
+
+        self._wakeup()
+
+        if thread and thread is not current_thread():
+            thread.join()
+
+        if pool:
+            pool.close()
+
+    def run(self):
+        """ Waits for readable/writable sockets and handles them.
+        """
+
+        while not self.stop:
+            try:
+                channels = self._get_channels()
+
+                rlist = [self._wakeup_r] + channels.keys()
+                wlist = [k for k, c in channels.iteritems() if
+                         c.writer.pending()]
+
+                ins, outs, _ = select.select(rlist, wlist, [], 5)
+            except (select.error, socket.error) as err:
+                self.logger.debug(err)
+                self._drop_closed()
+                continue
+
+            for fileno in ins:
+                if fileno == self._wakeup_r:
+                    os.read(self._wakeup_r, 4096)
+                else:
+                    self._on_readable(channels[fileno])
+
+            for fileno in outs:
+                channel = channels[fileno]
+                try:
+                    channel.writer.flush()
+                except socket.error as err:
+                    self.logger.debug('Socket is closed: %s' % err)
+                    self.unregister(channel.sid)
+
+        self.logger.debug('The data plane is now finished.')
+
+    def _on_readable(self, channel):
+        """ Reads the available data of the channel socket and dispatches the
+        completed frames to the workers.
+        """
+
+        try:
+            data = channel.sock.recv(524288)
+        except socket.error as err:
+            if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = ''
+
+        if not data:
+            self.logger.debug('Socket %s is closed.' % channel.sid)
+            self.unregister(channel.sid)
+            return
+
+        for frame, first_byte in channel.reader.feed(data):
+            self.pool.submit_ordered(channel.sid, proxy_socket.dispatch,
+                                     channel.sid, frame, channel.callback,
+                                     first_byte=first_byte)
+
+    def _get_channels(self):
+        """ Returns the dict of the registered channels by file descriptor.
+        The channels with a closed socket are unregistered.
+        """
+
+        with self._lock:
+            registered = self.channels.values()
+
+        channels = {}
+        for channel in registered:
+            try:
+                fileno = channel.sock.fileno()
+            except socket.error:
+                # The socket is closed by another thread.
+                fileno = -1
+
+            if fileno < 0:
+                self.unregister(channel.sid)
+            else:
+                channels[fileno] = channel
+
+        return channels
+
+    def _drop_closed(self):
+        """ Unregisters the channels with a closed socket.
+        """
+
+        for sid, channel in self.channels.items():
+            try:
+                channel.sock.fileno()
+                select.select([channel.sock], [], [], 0)
+            except (select.error, socket.error):
+                self.unregister(sid)
+
+    def _wakeup(self):
+        """ Wakes up the select call.
+        """
+
+        os.write(self._wakeup_w, 'x')
+
+
+dataplane = DataPlane()
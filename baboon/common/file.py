@@ -13,14 +13,21 @@ class FileEvent(object):
     MOVE = 2
     DELETE = 3
 
-    def __init__(self, project, event_type, src_path, dest_path=None):
-        """
+    def __init__(self, project, event_type, src_path, dest_path=None,
+                 content=None, oid=None, streamed=False):
+        """ The content is the optional zlib compressed content of the file
+        sent inline with the event. The oid is the optional git blob id of the
+        content of the file. If streamed is True, the content of the created
+        file is streamed over the bytestream.
         """
 
         self.project = project
         self.event_type = event_type
         self.src_path = src_path
         self.dest_path = dest_path
+        self.content = content
+        self.oid = oid
+        self.streamed = streamed
 
     def register(self):
 
@@ -35,3 +42,115 @@ class FileEvent(object):
                 hash(self.event_type) ^
                 hash(self.src_path) ^
                 hash(self.dest_path))
+
+
+class EventBatch(object):
+    """ An ordered batch of file events. The events superseded by a later
+    event on the same path are dropped (e.g. a file modified five times is
+    synced once). Events are never reordered across a MOVE event involving
+    their path, but a creation or modification of a moved path becomes a
+    modification of its destination. The moves of the files of a moved
+    directory are dropped too, the directory move is enough.
+    """
+
+    def __init__(self):
+
+        # The ordered list of events. A dropped event is replaced by None.
+        self.events = []
+
+        # Keys -> path, Values -> indexes in self.events of the events on
+        # this path since the last MOVE involving it.
+        self.by_path = {}
+
+        # The (src_path, dest_path) of the MOVE events of the batch.
+        self.moves = []
+
+    def __len__(self):
+        return len(self.events) - self.events.count(None)
+
+    def add(self, file_event):
+        """ Adds the file_event to the batch and drops the events it
+        supersedes.
+        """
+
+        if file_event.event_type == FileEvent.MOVE:
+            # The file is moved with its parent directory.
+            for src_path, dest_path in self.moves:
+                if file_event.src_path.startswith(src_path + '/') and \
+                        file_event.dest_path == dest_path + \
+                        file_event.src_path[len(src_path):]:
+                    return
+
+            # The content of a moved path is read when the batch is synced,
+            # from its destination. Its creation or modification becomes a
+            # modification of the destination, after the move.
+            modified = []
+            for path, indexes in self.by_path.items():
+                if not is_under(path, file_event.src_path):
+                    continue
+
+                for i in indexes:
+                    if self.events[i].event_type in (FileEvent.CREATE,
+                                                     FileEvent.MODIF):
+                        self.events[i] = None
+                        if path not in modified:
+                            modified.append(path)
+
+            # The MOVE is a barrier. Forget the events on the moved paths.
+            for path in self.by_path.keys():
+                if is_under(path, file_event.src_path) or \
+                        is_under(path, file_event.dest_path):
+                    del self.by_path[path]
+
+            self.moves.append((file_event.src_path, file_event.dest_path))
+            self.events.append(file_event)
+
+            for path in modified:
+                self.add(FileEvent(file_event.project, FileEvent.MODIF,
+                                   file_event.dest_path +
+                                   path[len(file_event.src_path):]))
+            return
+
+        indexes = self.by_path.setdefault(file_event.src_path, [])
+        previous = dict([(self.events[i].event_type, i) for i in indexes])
+
+        if file_event.event_type == FileEvent.MODIF:
+            # The content is read when the batch is synced. The previous
+            # modification is enough.
+            if FileEvent.MODIF in previous:
+                return
+
+            superseded = (FileEvent.DELETE,)
+        elif file_event.event_type == FileEvent.CREATE:
+            superseded = (FileEvent.CREATE, FileEvent.DELETE)
+        else:
+            superseded = (FileEvent.CREATE, FileEvent.MODIF,
+                          FileEvent.DELETE)
+
+        for event_type in superseded:
+            if event_type in previous:
+                self.events[previous[event_type]] = None
+                indexes.remove(previous[event_type])
+
+        indexes.append(len(self.events))
+        self.events.append(file_event)
+
+    def extend(self, files):
+        """ Adds all the file events of the files list.
+        """
+
+        for f in files:
+            self.add(f)
+
+    def get_events(self):
+        """ Returns the ordered list of the remaining events.
+        """
+
+        return [x for x in self.events if x is not None]
+
+
+def is_under(path, parent):
+    """ Returns True if path is parent or is inside the parent directory.
+    """
+
+    return path == parent or path.startswith(parent.rstrip('/') + '/')
@@ -0,0 +1,183 @@
+import os
+import re
+import subprocess
+import tempfile
+
+from baboon.common.utils import exec_cmd
+from baboon.common.errors.baboon_exception import BaboonException
+
+# The paths of the .git directory synced by object id (refs and objects)
+# instead of byte by byte.
+OBJECT_PATHS = re.compile(r'^\.git/(objects/|refs/|packed-refs$)')
+
+# The namespaces of the refs owned by the client. The server-side refs of the
+# other namespaces (e.g. the remotes added by the merge verification) are never
+# deleted.
+OWNED_REFS = ('refs/heads/', 'refs/tags/')
+
+# A git object id (SHA-1 or SHA-256).
+OID = re.compile(r'^([0-9a-f]{40}|[0-9a-f]{64})$')
+
+
+def is_object_path(rel_path):
+    """ Returns True if the rel_path is synced by object id.
+    """
+
+    return bool(OBJECT_PATHS.match(rel_path))
+
+
+def get_refs(repo_path):
+    """ Returns the list of (refname, object id) of the repository.
+    """
+
+    ret, output, _ = exec_cmd("git for-each-ref --format='%(objectname) "
+                              "%(refname)'", repo_path)
+    if ret:
+        raise BaboonException("Cannot list the refs of %s." % repo_path)
+
+    refs = []
+    for line in output.splitlines():
+        oid, name = line.split(' ', 1)
+        refs.append((name, oid))
+
+    return refs
+
+
+def get_known(repo_path, oids):
+    """ Returns the object ids of oids that exist in the repository.
+    """
+
+    if not oids:
+        return []
+
+    proc = subprocess.Popen(['git', 'cat-file', '--batch-check'],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, cwd=repo_path)
+    output, _ = proc.communicate('\n'.join(oids) + '\n')
+
+    return [line.split()[0] for line in output.splitlines() if
+            not line.endswith(' missing')]
+
+
+def hash_objects(repo_path, rel_paths):
+    """ Returns the list of the git blob ids of the rel_paths files, as
+    stored in the repository (i.e. without any filter). Returns None if a file
+    cannot be hashed.
+    """
+
+    proc = subprocess.Popen(['git', 'hash-object', '--no-filters',
+                             '--stdin-paths'], stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            cwd=repo_path)
+    output, _ = proc.communicate('\n'.join(rel_paths) + '\n')
+    if proc.returncode:
+        return None
+
+    oids = output.split()
+    if len(oids) != len(rel_paths):
+        return None
+
+    return oids
+
+
+def get_blob(repo_path, oid):
+    """ Returns the content of the oid blob if it exists in the repository.
+    Otherwise, returns None.
+    """
+
+    # The oid comes from the client.
+    if not OID.match(oid):
+        return None
+
+    proc = subprocess.Popen(['git', 'cat-file', 'blob', oid],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            cwd=repo_path)
+    content, _ = proc.communicate()
+    if proc.returncode:
+        return None
+
+    return content
+
+
+def create_bundle(repo_path, refs, haves):
+    """ Returns the content of a bundle of the refs without the objects
+    reachable from the haves object ids. Returns None if there's no object to
+    send.
+    """
+
+    # The haves unknown locally cannot be excluded.
+    known = get_known(repo_path, haves)
+
+    fd, path = tempfile.mkstemp(suffix='.bundle')
+    os.close(fd)
+
+    try:
+        cmd = 'git bundle create %s %s' % (path, ' '.join([x[0] for x in
+                                                           refs]))
+        if known:
+            cmd += ' --not %s' % ' '.join(known)
+
+        ret, output, _ = exec_cmd(cmd, repo_path)
+        if ret:
+            # All the objects are already known by the server.
+            if 'empty bundle' in output:
+                return None
+
+            raise BaboonException("Cannot create the bundle of %s: %s" %
+                                  (repo_path, output))
+
+        with open(path, 'rb') as fd:
+            return fd.read()
+    finally:
+        os.remove(path)
+
+
+def unbundle(repo_path, data):
+    """ Stores the objects of the bundle data in the repository. The refs are
+    not updated.
+    """
+
+    # The bundle is written in the .git directory to stay on the same
+    # filesystem.
+    fd, path = tempfile.mkstemp(suffix='.bundle',
+                                dir=os.path.join(repo_path, '.git'))
+    try:
+        with os.fdopen(fd, 'wb') as bundle:
+            bundle.write(data)
+
+        ret, output, _ = exec_cmd('git bundle unbundle %s' % path, repo_path)
+        if ret:
+            raise BaboonException("Cannot unbundle in %s: %s" %
+                                  (repo_path, output))
+    finally:
+        os.remove(path)
+
+
+def update_refs(repo_path, refs):
+    """ Updates the refs of the repository to the list of (refname, object id)
+    refs in a single transaction. The owned refs missing from the list are
+    deleted.
+    """
+
+    current = dict(get_refs(repo_path))
+    wanted = dict(refs)
+
+    commands = []
+    for name, oid in refs:
+        if current.get(name) != oid:
+            commands.append('update %s %s\n' % (name, oid))
+
+    for name in current:
+        if name.startswith(OWNED_REFS) and name not in wanted:
+            commands.append('delete %s\n' % name)
+
+    if not commands:
+        return
+
+    proc = subprocess.Popen(['git', 'update-ref', '--stdin'],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, cwd=repo_path)
+    output, _ = proc.communicate(''.join(commands))
+    if proc.returncode:
+        raise BaboonException("Cannot update the refs of %s: %s" %
+                              (repo_path, output))
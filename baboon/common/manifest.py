@@ -0,0 +1,137 @@
+import struct
+
+from baboon.common.file import FileEvent
+from baboon.common.errors.baboon_exception import BaboonException
+
+# The manifest starts with the magic, the version of the format and the number
+# of entries.
+MAGIC = 'BBMF'
+VERSION = 1
+HEADER = struct.Struct('>4sBI')
+
+# Each entry starts with the event type, the flags and the length of the
+# source path, followed by the source path itself.
+ENTRY = struct.Struct('>BBH')
+
+# The length of the optional strings following the source path.
+LENGTH = struct.Struct('>H')
+
+# The length of the optional inline content.
+CONTENT_LENGTH = struct.Struct('>I')
+
+# The entry is followed by a destination path (e.g. FileEvent.MOVE).
+FLAG_DEST = 0x01
+
+# The entry is followed by the inline (compressed) content of the file.
+FLAG_CONTENT = 0x02
+
+# The entry is followed by the git blob id of the content of the file.
+FLAG_OID = 0x04
+
+# The content of the created file is streamed over the bytestream.
+FLAG_STREAM = 0x08
+
+
+def pack(files):
+    """ Packs the list of FileEvent into a compact binary manifest.
+    """
+
+    chunks = [HEADER.pack(MAGIC, VERSION, len(files))]
+    for f in files:
+        flags = 0
+        if f.dest_path is not None:
+            flags |= FLAG_DEST
+        if f.content is not None:
+            flags |= FLAG_CONTENT
+        if f.oid is not None:
+            flags |= FLAG_OID
+        if f.streamed:
+            flags |= FLAG_STREAM
+
+        src_path = _encode(f.src_path)
+        chunks.append(ENTRY.pack(f.event_type, flags, len(src_path)))
+        chunks.append(src_path)
+
+        if flags & FLAG_DEST:
+            dest_path = _encode(f.dest_path)
+            chunks.append(LENGTH.pack(len(dest_path)))
+            chunks.append(dest_path)
+
+        if flags & FLAG_CONTENT:
+            chunks.append(CONTENT_LENGTH.pack(len(f.content)))
+            chunks.append(f.content)
+
+        if flags & FLAG_OID:
+            oid = _encode(f.oid)
+            chunks.append(LENGTH.pack(len(oid)))
+            chunks.append(oid)
+
+    return ''.join(chunks)
+
+
+def unpack(project, data):
+    """ Unpacks the binary manifest data into a list of FileEvent for the
+    project. Raises a BaboonException if the manifest is malformed.
+    """
+
+    try:
+        magic, version, count = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise BaboonException("Unsupported manifest format.")
+
+        files = []
+        offset = HEADER.size
+        for _ in xrange(count):
+            event_type, flags, length = ENTRY.unpack_from(data, offset)
+            offset += ENTRY.size
+            src_path, offset = _read(data, offset, length)
+
+            dest_path = None
+            if flags & FLAG_DEST:
+                length = LENGTH.unpack_from(data, offset)[0]
+                dest_path, offset = _read(data, offset + LENGTH.size, length)
+
+            content = None
+            if flags & FLAG_CONTENT:
+                length = CONTENT_LENGTH.unpack_from(data, offset)[0]
+                offset += CONTENT_LENGTH.size
+                content = data[offset:offset + length]
+                if len(content) != length:
+                    raise struct.error("unexpected end of manifest")
+                offset += length
+
+            oid = None
+            if flags & FLAG_OID:
+                length = LENGTH.unpack_from(data, offset)[0]
+                oid, offset = _read(data, offset + LENGTH.size, length)
+
+            streamed = bool(flags & FLAG_STREAM)
+            files.append(FileEvent(project, event_type, src_path,
+                                   dest_path=dest_path, content=content,
+                                   oid=oid, streamed=streamed))
+
+        return files
+    except (struct.error, UnicodeDecodeError) as err:
+        raise BaboonException("Malformed manifest: %s" % err)
+
+
+def _encode(path):
+    """ Returns the path encoded in UTF-8.
+    """
+
+    if isinstance(path, unicode):
+        return path.encode('utf-8')
+
+    return path
+
+
+def _read(data, offset, length):
+    """ Returns the UTF-8 string of length bytes at the offset of data and the
+    offset following it.
+    """
+
+    end = offset + length
+    if end > len(data):
+        raise struct.error("unexpected end of manifest")
+
+    return data[offset:end].decode('utf-8'), end
@@ -5,9 +5,11 @@ import struct
 import socket
 import threading
 import select
+import time
 
 
 from baboon.common.logger import logger
+from baboon.common.stats import stats
 
 logger = logging.getLogger(__name__)
 
@@ -44,13 +46,28 @@ def _run(sid, sock, callback):
             break
 
         for s in ins:
+            # The socket is readable: the first byte of the frame is
+            # available.
+            first_byte = time.time()
+
             data = _recv_size(sock)
             if not data:
                 socket_open = False
             else:
-                unpacked_data = unpack(data)
-                if unpacked_data:
-                    callback(sid, unpacked_data)
+                dispatch(sid, data, callback, first_byte=first_byte)
+
+
+def dispatch(sid, data, callback, first_byte=None):
+    """ Unpacks the data of a frame received on the socket associated to the
+    SID and calls the callback with the result.
+    """
+
+    unpacked_data = unpack(data)
+    if unpacked_data:
+        # The 4 bytes of the frame size are part of the frame.
+        stats.frame_in(sid, unpacked_data.get('node'), len(data) + 4,
+                       rid=unpacked_data.get('rid'), first_byte=first_byte)
+        callback(sid, unpacked_data)
 
 
 def _recv_size(sock):
@@ -89,8 +106,10 @@ def pack(data):
     """
 
     # The data format is: `len_data`+`data`. Useful to receive all the data
-    # at once (avoid splitted data) thanks to the recv_size method.
-    data = pickle.dumps(data)
+    # at once (avoid splitted data) thanks to the recv_size method. The
+    # binary pickle protocol avoids to escape binary strings (deltas,
+    # manifests...).
+    data = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
     return struct.pack('>i', len(data)) + data
 
 
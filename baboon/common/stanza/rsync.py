@@ -1,8 +1,56 @@
+import base64
+
 from sleekxmpp.xmlstream import register_stanza_plugin, ElementBase, ET
+from sleekxmpp.xmlstream.tostring import escape
 from sleekxmpp import Iq
 
 from baboon.common.file import FileEvent
 
+# The tag of the Rsync child element for each kind of file event.
+FILE_TAGS = {
+    FileEvent.MODIF: 'file',
+    FileEvent.CREATE: 'create_file',
+    FileEvent.MOVE: 'move_file',
+    FileEvent.DELETE: 'delete_file',
+}
+
+
+def encoded_size(text):
+    """ Returns the number of bytes of the text once encoded in UTF-8.
+    """
+
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+
+    return len(text)
+
+
+def file_element_size(file_event):
+    """ Returns the number of bytes of the file_event child element once
+    serialized in a Rsync stanza.
+    """
+
+    tag = FILE_TAGS[file_event.event_type]
+    size = encoded_size(escape(file_event.src_path)) + 2 * len(tag) + 5
+
+    # The destination path is a dest="..." attribute.
+    if file_event.dest_path is not None:
+        size += len(' dest=""') + encoded_size(escape(file_event.dest_path))
+
+    # The inline content is a base64 content="..." attribute.
+    if file_event.content is not None:
+        size += len(' content=""') + 4 * ((len(file_event.content) + 2) / 3)
+
+    # The streamed content is announced by a stream="1" attribute.
+    if file_event.streamed:
+        size += len(' stream="1"')
+
+    # The git blob id is an oid="..." attribute.
+    if file_event.oid is not None:
+        size += len(' oid=""') + len(file_event.oid)
+
+    return size
+
 
 class GitInit(ElementBase):
     name = 'git-init'
@@ -11,12 +59,37 @@ class GitInit(ElementBase):
     interfaces = set(('node', 'url',))
 
 
+# A get request returns the server-side refs. A set request gives the
+# client-side refs and tells if a bundle of the missing objects is sent over
+# the bytestream.
+class GitSync(ElementBase):
+    name = 'git-sync'
+    namespace = 'baboon'
+    plugin_attrib = 'git-sync'
+    interfaces = set(('sid', 'rid', 'node', 'bundle', 'refs'))
+    sub_interfaces = set(('refs',))
+
+    def get_refs(self):
+        return [(element.get('name'), element.text) for element in
+                self.xml.getchildren()]
+
+    def add_ref(self, name, oid):
+        ref_xml = ET.Element('{%s}ref' % self.namespace)
+        ref_xml.set('name', name)
+        ref_xml.text = oid
+        self.xml.append(ref_xml)
+
+    def set_refs(self, refs):
+        for name, oid in refs:
+            self.add_ref(name, oid)
+
+
 class Rsync(ElementBase):
     name = 'rsync'
     namespace = 'baboon'
     plugin_attrib = 'rsync'
-    interfaces = set(('sid', 'rid', 'node', 'files', 'create_files',
-                      'move_files', 'delete_files'))
+    interfaces = set(('sid', 'rid', 'node', 'lane', 'manifest', 'bulk',
+                      'files', 'create_files', 'move_files', 'delete_files'))
     sub_interfaces = set(('files', 'create_files', 'move_files',
                           'delete_files'))
 
@@ -37,23 +110,55 @@ class Rsync(ElementBase):
             elif tag_name == 'delete_file':
                 file_event_type = FileEvent.DELETE
 
-            file_event = FileEvent(self['node'], file_event_type, element.text)
+            # The optional inline content of the file.
+            content = element.get('content')
+            if content is not None:
+                content = base64.b64decode(content)
+
+            file_event = FileEvent(self['node'], file_event_type, element.text,
+                                   dest_path=element.get('dest'),
+                                   content=content, oid=element.get('oid'),
+                                   streamed=element.get('stream') == '1')
             files.append(file_event)
 
         return files
 
-    def add_file(self, f):
+    def add_event(self, file_event):
+        """ Adds the child element corresponding to the file_event.
+        """
+
+        if file_event.event_type == FileEvent.MODIF:
+            self.add_file(file_event.src_path, content=file_event.content,
+                          oid=file_event.oid)
+        elif file_event.event_type == FileEvent.CREATE:
+            self.add_create_file(file_event.src_path,
+                                 content=file_event.content,
+                                 streamed=file_event.streamed)
+        elif file_event.event_type == FileEvent.MOVE:
+            self.add_move_file(file_event.src_path, file_event.dest_path)
+        elif file_event.event_type == FileEvent.DELETE:
+            self.add_delete_file(file_event.src_path)
+
+    def add_file(self, f, content=None, oid=None):
         file_xml = ET.Element('{%s}file' % self.namespace)
         file_xml.text = f
+        if content is not None:
+            file_xml.set('content', base64.b64encode(content))
+        if oid is not None:
+            file_xml.set('oid', oid)
         self.xml.append(file_xml)
 
     def set_files(self, files):
         for f in files:
             self.add_file(f)
 
-    def add_create_file(self, f):
+    def add_create_file(self, f, content=None, streamed=False):
         file_xml = ET.Element('{%s}create_file' % self.namespace)
         file_xml.text = f
+        if content is not None:
+            file_xml.set('content', base64.b64encode(content))
+        if streamed:
+            file_xml.set('stream', '1')
         self.xml.append(file_xml)
 
     def set_create_files(self, files):
@@ -69,20 +174,21 @@ class Rsync(ElementBase):
         for f in files:
             self.add_delete_file(f)
 
-    def add_move_file(self, f):
+    def add_move_file(self, f, dest):
         file_xml = ET.Element('{%s}move_file' % self.namespace)
         file_xml.text = f
+        file_xml.set('dest', dest)
         self.xml.append(file_xml)
 
     def set_move_files(self, files):
-        for f in files:
-            self.add_move_file(f)
+        for f, dest in files:
+            self.add_move_file(f, dest)
 
 
 class RsyncFinished(ElementBase):
     name = 'rsyncfinished'
     namespace = 'baboon'
-    interfaces = set(('node', ))
+    interfaces = set(('node', 'rid'))
     plugin_attrib = 'rsyncfinished'
 
 
@@ -113,6 +219,7 @@ class MergeStatus(ElementBase):
             self.add_file(f)
 
 register_stanza_plugin(Iq, GitInit)
+register_stanza_plugin(Iq, GitSync)
 register_stanza_plugin(Iq, Rsync)
 register_stanza_plugin(Iq, RsyncFinished)
 register_stanza_plugin(Iq, MergeVerification)
@@ -0,0 +1,305 @@
+import time
+
+from threading import Thread, Lock
+
+from baboon.common.logger import logger
+
+# The upper bounds (in seconds) of the latency histogram buckets. A last
+# implicit bucket catches everything above the last bound.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, 120, 240)
+
+# The number of seconds a request without response is remembered. Longer than
+# the longest sync timeout (the background lane).
+REQUEST_TTL = 7200
+
+
+class Histogram(object):
+    """ A fixed buckets histogram. Cheap enough to be updated for every
+    frame.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value):
+        """ Adds the value to the correct bucket.
+        """
+
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+
+    def percentile(self, percent):
+        """ Returns the upper bound of the bucket containing the percent
+        percentile. Returns None if the histogram is empty or if the
+        percentile is in the last (unbounded) bucket.
+        """
+
+        if not self.count:
+            return None
+
+        threshold = self.count * percent / 100.0
+        cumulated = 0
+        for i, count in enumerate(self.counts):
+            cumulated += count
+            if cumulated >= threshold:
+                return self.buckets[i] if i < len(self.buckets) else None
+
+    def snapshot(self):
+        """ Returns a dict representation of the histogram.
+        """
+
+        return {
+            'count': self.count,
+            'avg': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'buckets': zip(self.buckets + ('inf',), self.counts),
+        }
+
+
+@logger
+class Stats(object):
+    """ Collects transfer statistics (bytes and frames in/out) per bytestream
+    SID and per project, the latency histograms (time-to-first-byte,
+    full-message, hashing...) and the delta compression ratio of each synced
+    file.
+    """
+
+    def __init__(self):
+
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        """ Forgets all the collected statistics.
+        """
+
+        with self._lock:
+            # Keys -> SID/project, Values -> dict of counters.
+            self.by_sid = {}
+            self.by_project = {}
+
+            # Keys -> project, Values -> {histogram name => Histogram}.
+            self.histograms = {}
+
+            # Keys -> project, Values -> {relpath => (file_size, delta_size)}.
+            self.deltas = {}
+
+            # Keys -> RID, Values -> the timestamp the request was sent. Used
+            # to compute the time-to-first-byte of the response.
+            self.requests = {}
+
+    def request_started(self, rid):
+        """ Registers the time the request identified by the rid is sent. The
+        next frame received with the same rid is the response.
+        """
+
+        now = time.time()
+        with self._lock:
+            # Forget the requests that never got a response frame.
+            for key, started in self.requests.items():
+                if now - started > REQUEST_TTL:
+                    del self.requests[key]
+
+            self.requests[rid] = now
+
+    def request_finished(self, rid):
+        """ Forgets the request identified by the rid. Called when the sync
+        is finished, a request without any response frame (e.g. no hash
+        exchange, git sync) is never popped by frame_in.
+        """
+
+        with self._lock:
+            self.requests.pop(rid, None)
+
+    def frame_out(self, sid, project, nbytes):
+        """ Registers a frame of nbytes sent over the sid bytestream.
+        """
+
+        with self._lock:
+            self._count(sid, project, 'out', nbytes)
+
+    def frame_in(self, sid, project, nbytes, rid=None, first_byte=None):
+        """ Registers a frame of nbytes received over the sid bytestream. If
+        the frame is the response of a request registered with
+        request_started, the first_byte timestamp is used to compute the
+        time-to-first-byte and the full-message latencies.
+        """
+
+        now = time.time()
+        with self._lock:
+            self._count(sid, project, 'in', nbytes)
+
+            started = self.requests.pop(rid, None)
+            if started is not None:
+                if first_byte is not None:
+                    self._observe(project, 'ttfb', first_byte - started)
+                self._observe(project, 'latency', now - started)
+
+    def observe(self, project, name, seconds):
+        """ Adds the seconds duration to the name histogram of the project.
+        """
+
+        with self._lock:
+            self._observe(project, name, seconds)
+
+    def delta(self, project, relpath, file_size, delta):
+        """ Registers the pyrsync delta computed for the relpath file of
+        file_size bytes.
+        """
+
+        delta_size = delta_wire_size(delta)
+        with self._lock:
+            self.deltas.setdefault(project, {})[relpath] = (file_size,
+                                                            delta_size)
+
+    def ratio(self, project, relpath=None):
+        """ Returns the compression ratio (delta size / file size) of the
+        relpath file or of the whole project if relpath is None. Returns None
+        if nothing is known.
+        """
+
+        with self._lock:
+            deltas = self.deltas.get(project, {})
+            if relpath is not None:
+                deltas = {relpath: deltas[relpath]} if relpath in deltas \
+                    else {}
+
+            file_size = sum([x[0] for x in deltas.values()])
+            delta_size = sum([x[1] for x in deltas.values()])
+
+        if not file_size:
+            return None
+
+        return float(delta_size) / file_size
+
+    def snapshot(self):
+        """ Returns a dict representation of all the statistics.
+        """
+
+        with self._lock:
+            snapshot = {
+                'sids': dict([(k, dict(v)) for k, v in
+                              self.by_sid.iteritems()]),
+                'projects': dict([(k, dict(v)) for k, v in
+                                  self.by_project.iteritems()]),
+                'histograms': {},
+            }
+
+            for project, histograms in self.histograms.iteritems():
+                snapshot['histograms'][project] = dict(
+                    [(k, v.snapshot()) for k, v in histograms.iteritems()])
+
+        for project in snapshot['projects']:
+            snapshot['projects'][project]['ratio'] = self.ratio(project)
+
+        return snapshot
+
+    def summary(self):
+        """ Returns a one-line summary of the statistics of each project.
+        """
+
+        parts = []
+        snapshot = self.snapshot()
+        for project in sorted(snapshot['projects']):
+            counters = snapshot['projects'][project]
+            histograms = snapshot['histograms'].get(project, {})
+
+            part = '[%s] in=%dB/%d out=%dB/%d' % (
+                project, counters['bytes_in'], counters['frames_in'],
+                counters['bytes_out'], counters['frames_out'])
+            for name in sorted(histograms):
+                part += ' %s(p50=%s,p99=%s)' % (name, histograms[name]['p50'],
+                                                histograms[name]['p99'])
+            if counters['ratio'] is not None:
+                part += ' ratio=%.3f' % counters['ratio']
+
+            parts.append(part)
+
+        return ' '.join(parts) or 'No transfer yet.'
+
+    def _count(self, sid, project, direction, nbytes):
+        """ Updates the counters of the sid and the project. The lock must be
+        held.
+        """
+
+        for key, src in ((sid, self.by_sid), (project, self.by_project)):
+            if key is None:
+                continue
+
+            counters = src.get(key)
+            if counters is None:
+                counters = src[key] = {'bytes_in': 0, 'bytes_out': 0,
+                                       'frames_in': 0, 'frames_out': 0}
+
+            counters['bytes_%s' % direction] += nbytes
+            counters['frames_%s' % direction] += 1
+
+    def _observe(self, project, name, seconds):
+        """ Adds the seconds duration to the name histogram of the project.
+        The lock must be held.
+        """
+
+        histograms = self.histograms.setdefault(project, {})
+        if name not in histograms:
+            histograms[name] = Histogram()
+
+        histograms[name].add(seconds)
+
+
+@logger
+class StatsReporter(Thread):
+    """ A thread that wakes up every <interval> secs and logs the statistics
+    summary.
+    """
+
+    def __init__(self, interval=60):
+        """ Initializes the thread.
+        """
+
+        Thread.__init__(self, name='StatsReporter')
+
+        self.daemon = True
+        self.interval = interval
+        self.stop = False
+
+    def run(self):
+        """ Runs the thread.
+        """
+
+        while not self.stop:
+            time.sleep(self.interval)
+            self.logger.info(stats.summary())
+
+    def close(self):
+        """ Sets the stop flag to True.
+        """
+
+        self.stop = True
+
+
+def delta_wire_size(delta):
+    """ Returns the approximate number of bytes needed to transfer the pyrsync
+    delta: the literal data plus 4 bytes by block reference.
+    """
+
+    size = 0
+    for element in delta[1:]:
+        size += 4 if isinstance(element, int) else len(element)
+
+    return size
+
+
+stats = Stats()
@@ -0,0 +1,132 @@
+import sys
+
+from collections import deque
+from threading import Thread, Lock
+
+if sys.version_info < (3, 0):
+    from Queue import Queue
+else:
+    from queue import Queue
+
+from baboon.common.logger import logger
+
+
+@logger
+class WorkerPool(object):
+    """ A fixed-size pool of threads to offload work. Jobs submitted with the
+    same key with submit_ordered are executed one after another, in the
+    submission order. Other jobs are executed as soon as a worker is
+    available.
+    """
+
+    def __init__(self, size, name='Worker', maxsize=0):
+        """ Initializes the pool. The worker threads are started by the start
+        method. If maxsize is not 0, is_full tells when maxsize jobs are
+        already pending.
+        """
+
+        self.size = size
+        self.name = name
+        self.maxsize = maxsize
+        self.workers = []
+
+        # The number of jobs submitted and not yet executed.
+        self.pending = 0
+
+        # The queue of jobs ready to be executed. A job is a tuple (fn, args,
+        # kwargs, key).
+        self.jobs = Queue()
+
+        # Keys -> the key of the jobs currently running or waiting in the
+        # jobs queue. Values -> the deque of the jobs with the same key
+        # waiting their turn.
+        self._ordered = {}
+        self._lock = Lock()
+
+    def start(self):
+        """ Starts the worker threads.
+        """
+
+        for i in range(self.size):
+            worker = Thread(target=self._run, name='%s-%d' % (self.name, i))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def is_full(self):
+        """ Returns True if maxsize jobs are pending.
+        """
+
+        return bool(self.maxsize) and self.pending >= self.maxsize
+
+    def submit(self, fn, *args, **kwargs):
+        """ Executes fn(*args, **kwargs) in one of the workers.
+        """
+
+        with self._lock:
+            self.pending += 1
+
+        self.jobs.put((fn, args, kwargs, None))
+
+    def submit_ordered(self, key, fn, *args, **kwargs):
+        """ Executes fn(*args, **kwargs) in one of the workers, after all the
+        jobs previously submitted with the same key.
+        """
+
+        with self._lock:
+            self.pending += 1
+            if key in self._ordered:
+                self._ordered[key].append((fn, args, kwargs))
+                return
+
+            self._ordered[key] = deque()
+
+        self.jobs.put((fn, args, kwargs, key))
+
+    def close(self):
+        """ Stops all the worker threads once the already submitted jobs are
+        executed.
+        """
+
+        for worker in self.workers:
+            self.jobs.put(None)
+
+        for worker in self.workers:
+            worker.join()
+
+        self.workers = []
+
+    def _run(self):
+        """ Consumes the jobs queue until a None job.
+        """
+
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+
+            fn, args, kwargs, key = job
+            try:
+                fn(*args, **kwargs)
+            except Exception as err:
+                self.logger.exception(err)
+            finally:
+                with self._lock:
+                    self.pending -= 1
+
+                if key is not None:
+                    self._next(key)
+
+    def _next(self, key):
+        """ Queues the next job of the key, if any.
+        """
+
+        with self._lock:
+            waiting = self._ordered[key]
+            if not waiting:
+                del self._ordered[key]
+                return
+
+            fn, args, kwargs = waiting.popleft()
+
+        self.jobs.put((fn, args, kwargs, key))